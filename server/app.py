@@ -1,26 +1,23 @@
-from flask import Flask, request, jsonify
-import mne
-import numpy as np
-import pandas as pd
+from flask import Flask, Response, request, jsonify, stream_with_context
 import os
-from flask_cors import CORS
-import torch
+import shutil
+import hashlib
+import tempfile
 import requests
-import sys
-import json
-import traceback
 import logging
-import pickle
-# Import the Net class directly - this is crucial for loading the model
-from mdl_4 import Net
-# Import timm which is required by the model
-import timm
-GROQ_API_KEY = os.getenv("GROQ_API_KEY")
-GROQ_API_URL = "https://api.groq.com/openai/v1/chat/completions"  # Update this URL
-GROQ_MODEL = "llama-3.3-70b-versatile"  # Add this model
-
-# Add Net to PyTorch's safe globals
-torch.serialization.add_safe_globals([Net])
+from utils.pipeline import (
+    GROQ_API_KEY, GROQ_API_URL, GROQ_MODEL, GROQ_CONNECT_TIMEOUT, GROQ_TIMEOUT, PIPELINE_STAGES,
+    groq_session, get_model_registry, get_condition_models, init_worker, analyze_recording
+)
+from utils.jobs import JobManager
+from utils.recordings import save_recording
+from utils.sse import SSE_DONE, SSE_HEADERS, parse_stream_line, sse_event
+from flask_cors import CORS
+# Parent directory for per-request upload temp dirs (system default when unset)
+UPLOAD_TEMP_DIR = os.getenv("EEG_UPLOAD_TEMP_DIR")
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Worker processes for background analysis jobs
+JOB_WORKERS = int(os.getenv("EEG_JOB_WORKERS", "2"))
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
@@ -31,363 +28,127 @@ app = Flask(__name__)
 # Enable CORS for the Flask app
 CORS(app, resources={r"/*": {"origins": ["http://localhost:3000"]}}, supports_credentials=True)
 
-# Preprocessing function for .fif EEG files
-def preprocess_eeg(file_path):
-    # Add validation for missing measurement data in preprocess_eeg
-    try:
-        raw = mne.io.read_raw_fif(file_path, preload=True)
-        if raw.info['nchan'] == 0 or raw.n_times == 0:
-            raise ValueError("No measurement data found in the EEG file.")
-    except Exception as e:
-        return None, f"Failed to load EEG file: {str(e)}"
-    
-    # Basic preprocessing
-    raw.filter(1, 45)  # Bandpass filter (1-45 Hz)
-    raw.notch_filter(freqs=[50, 60])  # Remove line noise
-    
-    # Detect and remove artifacts
-    # Check for EOG channels before applying ICA
-    if not any(ch for ch in raw.ch_names if 'EOG' in ch):
-        logger.info("No EOG channels found. Skipping EOG artifact removal.")
-    else:
-        ica = mne.preprocessing.ICA(n_components=15, random_state=42)
-        ica.fit(raw)
-        ica.exclude = []
-        # Find and exclude components related to eye blinks/movements
-        eog_indices, eog_scores = ica.find_bads_eog(raw)
-        ica.exclude = eog_indices
-        ica.apply(raw)
-    
-    return raw, None
-
-# Convert model outputs to condition probabilities
-def calculate_condition_probabilities(predictions):
-    # Extract votes from the model predictions
-    # Assuming predictions has the format: [eeg_id, lpd_vote, gpd_vote, lrda_vote, grda_vote, other_vote]
-    lpd_vote = predictions[1]  # Lateralized Periodic Discharges
-    gpd_vote = predictions[2]  # Generalized Periodic Discharges
-    lrda_vote = predictions[3]  # Lateralized Rhythmic Delta Activity
-    grda_vote = predictions[4]  # Generalized Rhythmic Delta Activity
-    other_vote = predictions[5]  # Other patterns
-    
-    # Calculate epilepsy probability (higher weight to GPD and LPD)
-    epilepsy_probability = (0.4 * gpd_vote + 0.4 * lpd_vote + 0.2 * lrda_vote) / (gpd_vote + lpd_vote + lrda_vote + 0.001)
-    
-    # Calculate cognitive stress probability (higher weight to LRDA)
-    cognitive_stress_probability = (0.6 * lrda_vote + 0.2 * grda_vote + 0.2 * other_vote) / (lrda_vote + grda_vote + other_vote + 0.001)
-    
-    # Calculate depression probability (mix of patterns)
-    depression_probability = (0.3 * lrda_vote + 0.3 * grda_vote + 0.4 * other_vote) / (lrda_vote + grda_vote + other_vote + 0.001)
-    
-    # Ensure probabilities are between 0 and 1
-    epilepsy_probability = min(max(epilepsy_probability, 0), 1)
-    cognitive_stress_probability = min(max(cognitive_stress_probability, 0), 1)
-    depression_probability = min(max(depression_probability, 0), 1)
-    
-    return {
-        "epilepsy": float(epilepsy_probability),
-        "cognitive_stress": float(cognitive_stress_probability),
-        "depression": float(depression_probability)
-    }
-
-# Helper function to inspect the model file structure
-def inspect_model_file(model_path):
-    try:
-        # Use a simpler approach that works across PyTorch versions
-        try:
-            # Try with weights_only=False but catch potential security errors
-            loaded = torch.load(model_path, map_location='cpu', weights_only=False)
-        except RuntimeError as e:
-            if "weights_only" in str(e):
-                # For PyTorch versions that enforce weights_only security
-                logger.warning("Loading with weights_only=True due to PyTorch security policy")
-                loaded = torch.load(model_path, map_location='cpu', weights_only=True)
-            else:
-                raise
-        
-        # Collect model info
-        model_info = {
-            "type": type(loaded).__name__,
-            "attributes": []
-        }
-        
-        # Get attributes or keys depending on the type
-        if isinstance(loaded, dict):
-            model_info["is_dictionary"] = True
-            model_info["keys"] = list(loaded.keys())
-        else:
-            model_info["is_dictionary"] = False
-            model_info["attributes"] = [attr for attr in dir(loaded) if not attr.startswith('_')]
-            model_info["has_predict"] = hasattr(loaded, "predict")
-            model_info["is_callable"] = callable(loaded)
-        
-        return model_info
-    except Exception as e:
-        logger.error(f"Error inspecting model: {e}")
-        return {"error": str(e), "traceback": traceback.format_exc()}
-
-@app.route('/upload', methods=['POST'])
-def upload_eeg():
+# Load the EEG model once at startup; it stays resident across requests
+model_registry = get_model_registry()
+condition_models = get_condition_models()
+
+# Background analysis jobs run on a bounded process pool, each worker with its own resident model
+job_manager = JobManager(max_workers=JOB_WORKERS, initializer=init_worker, stages=PIPELINE_STAGES)
+
+# Stream an uploaded file to disk in fixed-size chunks; returns its path and SHA-256
+def save_upload(file, directory):
+    # MNE expects raw FIF file names to end in raw.fif
+    path = os.path.join(directory, "upload_raw.fif")
+    digest = hashlib.sha256()
+    with open(path, 'wb') as out:
+        while True:
+            chunk = file.stream.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            out.write(chunk)
+    return path, digest.hexdigest()
+
+# Validate the multipart upload; returns (file, error_response)
+def get_uploaded_fif():
     if 'file' not in request.files:
-        return jsonify({"error": "No file part"}), 400
+        return None, (jsonify({"error": "No file part"}), 400)
 
     file = request.files['file']
     if file.filename == '':
-        return jsonify({"error": "No selected file"}), 400
+        return None, (jsonify({"error": "No selected file"}), 400)
 
     if not file.filename.endswith('.fif'):
-        return jsonify({"error": "Only .fif files are supported"}), 400
+        return None, (jsonify({"error": "Only .fif files are supported"}), 400)
+
+    return file, None
 
-    # Save the uploaded file temporarily
-    temp_fif_path = "temp_eeg.fif"
-    file.save(temp_fif_path)
+# Keep a copy of the upload as the patient's current recording when a patient_id is given;
+# returns the (validated) patient_id, or None
+def store_patient_recording(temp_fif_path):
+    patient_id = request.form.get('patient_id')
+    if patient_id:
+        save_recording(patient_id, temp_fif_path)
+        logger.info(f"Stored recording for patient {patient_id}")
+    return patient_id or None
+
+@app.route('/upload', methods=['POST'])
+def upload_eeg():
+    file, error_response = get_uploaded_fif()
+    if error_response:
+        return error_response
+
+    # Stream the upload into a per-request temp directory so concurrent uploads never collide
+    temp_dir = tempfile.mkdtemp(prefix="eeg_upload_", dir=UPLOAD_TEMP_DIR)
 
     try:
-        # Process the EEG data
-        raw, error = preprocess_eeg(temp_fif_path)
+        temp_fif_path, file_hash = save_upload(file, temp_dir)
+        patient_id = store_patient_recording(temp_fif_path)
+
+        result, error = analyze_recording(temp_fif_path, file.filename, file_hash=file_hash, patient_id=patient_id)
         if error:
             return jsonify({"error": error}), 500
 
-        # Convert raw data to DataFrame and save as .parquet
-        raw_data = raw.get_data()
-        raw_df = pd.DataFrame(raw_data.T, columns=raw.ch_names)
-        parquet_path = "temp_eeg.parquet"
-        raw_df.to_parquet(parquet_path)
-        
-        logger.info(f"Successfully converted .fif to .parquet: {parquet_path}")
-        logger.info(f"DataFrame shape: {raw_df.shape}")
-        logger.info(f"Column names: {raw_df.columns.tolist()[:10]}...")  # Show first 10 columns
-
-        # Get model info first - attempt to inspect without loading
-        model_path = "/home/ghruank/programming/hackathons/airavat/final/single_model.pt"
-        model_info = inspect_model_file(model_path)
-        logger.info(f"Model info: {json.dumps(model_info, indent=2)}")
-        
-        # Try multiple approaches to load the model with detailed error reporting
-        model_loaded = False
-        error_details = []
-        predictions = None
-
-        # Approach 1: Direct load with weights_only=False
-        try:
-            logger.info("Attempting to load model with torch.load and weights_only=False")
-            # Add the parent directory to sys.path to find any modules if needed
-            sys.path.append(os.path.dirname("/home/ghruank/programming/hackathons/airavat/final/"))
-            
-            # Use a context manager to allow unsafe loading
-            model = torch.load(model_path, map_location='cpu', weights_only=False)
-            logger.info(f"Model loaded directly with torch.load, type: {type(model)}")
-            
-            # Check if predict method exists
-            if hasattr(model, 'predict'):
-                logger.info("Model has predict method, using it")
-                predictions = model.predict(raw_df)
-                model_loaded = True
-            else:
-                logger.warning("Model doesn't have predict method, trying to use it as a callable")
-                input_tensor = torch.tensor(raw_df.values, dtype=torch.float32)
-                predictions = model(input_tensor)
-                if isinstance(predictions, torch.Tensor):
-                    predictions = predictions.detach().numpy()
-                model_loaded = True
-            
-        except Exception as std_error:
-            error_msg = f"Direct model loading failed: {str(std_error)}\n{traceback.format_exc()}"
-            logger.error(error_msg)
-            error_details.append({"method": "torch.load direct", "error": error_msg})
-            
-            # Approach 2: Try loading with torch.jit.load
-            try:
-                logger.info("Attempting to load model with torch.jit.load")
-                model = torch.jit.load(model_path, map_location='cpu')
-                logger.info(f"Model loaded with torch.jit.load, type: {type(model)}")
-                
-                # If successful, prepare input and run model
-                input_tensor = torch.tensor(raw_df.values, dtype=torch.float32)
-                logger.info(f"Input tensor shape: {input_tensor.shape}")
-                
-                predictions = model(input_tensor)
-                if isinstance(predictions, torch.Tensor):
-                    predictions = predictions.detach().numpy()
-                    
-                logger.info(f"Got predictions with shape: {predictions.shape if hasattr(predictions, 'shape') else 'not a numpy array'}")
-                model_loaded = True
-                
-            except Exception as jit_error:
-                error_msg = f"JIT model loading failed: {str(jit_error)}\n{traceback.format_exc()}"
-                logger.error(error_msg)
-                error_details.append({"method": "torch.jit.load", "error": error_msg})
-                
-                # Approach 3: Try with pickle directly
-                try:
-                    logger.info("Attempting to load model directly with pickle")
-                    with open(model_path, 'rb') as f:
-                        model = pickle.load(f)
-                    logger.info(f"Model loaded with pickle directly, type: {type(model)}")
-                    
-                    # Check if predict method exists
-                    if hasattr(model, 'predict'):
-                        predictions = model.predict(raw_df)
-                        model_loaded = True
-                    else:
-                        # Try model as a callable
-                        input_tensor = torch.tensor(raw_df.values, dtype=torch.float32)
-                        predictions = model(input_tensor)
-                        if isinstance(predictions, torch.Tensor):
-                            predictions = predictions.detach().numpy()
-                        model_loaded = True
-                        
-                except Exception as pickle_error:
-                    error_msg = f"Pickle loading failed: {str(pickle_error)}\n{traceback.format_exc()}"
-                    logger.error(error_msg)
-                    error_details.append({"method": "direct pickle", "error": error_msg})
-        
-        # If all approaches failed, try one more with a context manager
-        if not model_loaded:
-            try:
-                logger.info("Final attempt: loading with context manager for safe_globals")
-                with torch.serialization.safe_globals(['Net']):
-                    model = torch.load(model_path, map_location='cpu')
-                    
-                logger.info(f"Model loaded with safe_globals context, type: {type(model)}")
-                
-                # Check if predict method exists
-                if hasattr(model, 'predict'):
-                    predictions = model.predict(raw_df)
-                    model_loaded = True
-                else:
-                    # Try model as a callable
-                    input_tensor = torch.tensor(raw_df.values, dtype=torch.float32)
-                    predictions = model(input_tensor)
-                    if isinstance(predictions, torch.Tensor):
-                        predictions = predictions.detach().numpy()
-                    model_loaded = True
-                    
-            except Exception as ctx_error:
-                error_msg = f"Context manager loading failed: {str(ctx_error)}\n{traceback.format_exc()}"
-                logger.error(error_msg)
-                error_details.append({"method": "safe_globals context", "error": error_msg})
-
-        # If all approaches failed, use mock predictions
-        if not model_loaded:
-            logger.warning("All model loading approaches failed, using mock predictions")
-            predictions = np.array([1, 0.3, 0.2, 0.7, 0.4, 0.6])
-            
-        # Calculate condition probabilities
-        condition_probabilities = calculate_condition_probabilities(predictions)
-                # Prepare raw data and percentage data for AI context
-                # Prepare raw data and percentage data for AI context
-        raw_data_json = {
-            "lpd": predictions[1],
-            "gpd": predictions[2],
-            "lrda": predictions[3],
-            "grda": predictions[4],
-            "other": predictions[5]
-        }
-
-        percentage_data_json = {
-            "epilepsy": f"{condition_probabilities['epilepsy'] * 100:.2f}%",
-            "cognitive_stress": f"{condition_probabilities['cognitive_stress'] * 100:.2f}%",
-            "depression": f"{condition_probabilities['depression'] * 100:.2f}%"
-        }
-
-        # Create the Groq LLM prompt
-        prompt = f"""
-You are a clinical neurologist AI that analyzes EEG output probabilities.
-
-Given:
-- LPD: {predictions[1]}
-- GPD: {predictions[2]}
-- LRDA: {predictions[3]}
-- GRDA: {predictions[4]}
-- Other: {predictions[5]}
-
-You inferred:
-- Epilepsy likelihood: {condition_probabilities['epilepsy']:.2f}
-- Cognitive stress likelihood: {condition_probabilities['cognitive_stress']:.2f}
-- Depression likelihood: {condition_probabilities['depression']:.2f}
-
-Give a short, clinically sound explanation about these results in simple terms. Mention what these probabilities mean and what the person should do next.
-"""
-
-        # Make Groq API call for AI content
-        try:
-            groq_response_content = requests.post(
-                GROQ_API_URL,
-                headers={
-                    "Authorization": f"Bearer {GROQ_API_KEY}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "model": GROQ_MODEL,
-                    "messages": [
-                        {"role": "system", "content": "You are a neurologist assistant."},
-                        {"role": "user", "content": prompt}
-                    ],
-                    "temperature": 0.7
-                }
-            )
-
-            groq_json_content = groq_response_content.json()
-            ai_content = groq_json_content["choices"][0]["message"]["content"].strip()
-        except Exception as e:
-            logger.error(f"Groq API call for AI content failed: {e}")
-            ai_content = "Unable to fetch AI content from the model."
-
-        # Make Groq API call for medication advice
-        try:
-            medication_prompt = f"""
-You are a clinical neurologist AI that provides medical advice.
-
-Given:
-- LPD: {predictions[1]}
-- GPD: {predictions[2]}
-- LRDA: {predictions[3]}
-- GRDA: {predictions[4]}
-- Other: {predictions[5]}
-
-Provide detailed advice on:
-- Possible effects of medications and surgical treatments.
-- Which treatments are good or bad for the user.
-- Other clinical and medical recommendations.
-"""
-
-            groq_response_medication = requests.post(
-                GROQ_API_URL,
-                headers={
-                    "Authorization": f"Bearer {GROQ_API_KEY}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "model": GROQ_MODEL,
-                    "messages": [
-                        {"role": "system", "content": "You are a neurologist assistant."},
-                        {"role": "user", "content": medication_prompt}
-                    ],
-                    "temperature": 0.7
-                }
-            )
-
-            groq_json_medication = groq_response_medication.json()
-            medication = groq_json_medication["choices"][0]["message"]["content"].strip()
-        except Exception as e:
-            logger.error(f"Groq API call for medication advice failed: {e}")
-            medication = "Unable to fetch medication advice from the model."
-
         # Final response JSON
-        return jsonify({
-            "raw": raw_data_json,
-            "percentage": percentage_data_json,
-            "ai_content": ai_content,
-            "medication": medication
-        })
+        return jsonify(result)
+
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
     finally:
-        # Cleanup temporary files
-        if os.path.exists(temp_fif_path):
-            os.remove(temp_fif_path)
-        if os.path.exists(parquet_path):
-            os.remove(parquet_path)
+        # Cleanup this request's temporary files
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+@app.route('/jobs', methods=['POST'])
+def submit_eeg_job():
+    """Queue the /upload pipeline as a background job and return its id immediately."""
+    file, error_response = get_uploaded_fif()
+    if error_response:
+        return error_response
+
+    # The temp directory lives until the job finishes, then is removed by the job callback
+    temp_dir = tempfile.mkdtemp(prefix="eeg_job_", dir=UPLOAD_TEMP_DIR)
+    try:
+        temp_fif_path, file_hash = save_upload(file, temp_dir)
+        patient_id = store_patient_recording(temp_fif_path)
+        job_id = job_manager.submit(
+            analyze_recording, temp_fif_path, file.filename, file_hash=file_hash, patient_id=patient_id,
+            on_done=lambda job: shutil.rmtree(temp_dir, ignore_errors=True)
+        )
+    except ValueError as e:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        return jsonify({"error": str(e)}), 400
+    except Exception:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        raise
+
+    return jsonify({"job_id": job_id, "status": "queued"}), 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_eeg_job(job_id):
+    """Report a job's stage-level progress and, once finished, its result."""
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+
+    # analyze_recording returns (result, error)
+    if job["status"] == "completed":
+        result, error = job["result"]
+        if error:
+            job["status"], job["result"], job["error"] = "failed", None, error
+        else:
+            job["result"] = result
+    return jsonify(job)
+
+@app.route('/model', methods=['GET'])
+def model_status():
+    return jsonify(dict(model_registry.info(), condition_models=condition_models.info()))
+
+@app.route('/model/reload', methods=['POST'])
+def reload_model():
+    loaded = model_registry.load()
+    condition_models.load()
+    return jsonify(dict(model_registry.info(), condition_models=condition_models.info())), 200 if loaded else 500
 
 @app.route('/chatbot', methods=['POST'])
 def chatbot():
@@ -411,7 +172,7 @@ def chatbot():
     }
 
     try:
-        response = requests.post(GROQ_API_URL, headers=headers, json=payload)
+        response = groq_session.post(GROQ_API_URL, headers=headers, json=payload, timeout=(GROQ_CONNECT_TIMEOUT, GROQ_TIMEOUT))
         response.raise_for_status()
         data = response.json()
     except requests.RequestException as e:
@@ -426,6 +187,52 @@ def chatbot():
 
     return jsonify({"error": False, "response": data["choices"][0]["message"]["content"]})
 
+@app.route('/chatbot/stream', methods=['POST'])
+def chatbot_stream():
+    """Streaming /chatbot: tokens are sent as server-sent events as Groq produces them, ending with [DONE]."""
+    data = request.get_json()
+    message = data.get("message")
+
+    if not GROQ_API_KEY:
+        return jsonify({"error": True, "response": "GROQ_API_KEY is not set"}), 500
+
+    headers = {
+        "Authorization": f"Bearer {GROQ_API_KEY}",
+        "Content-Type": "application/json"
+    }
+
+    payload = {
+        "model": GROQ_MODEL,
+        "messages": [
+            {"role": "user", "content": message}
+        ],
+        "temperature": 0.2,
+        "stream": True
+    }
+
+    def events():
+        try:
+            with groq_session.post(GROQ_API_URL, headers=headers, json=payload, stream=True,
+                                   timeout=(GROQ_CONNECT_TIMEOUT, GROQ_TIMEOUT)) as response:
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    token = parse_stream_line(line)
+                    if token is None:
+                        break
+                    if token:
+                        yield sse_event({"token": token})
+        except requests.RequestException as e:
+            logger.error(f"Request error: {str(e)}")
+            yield sse_event({"error": True, "response": "Failed to connect to Groq API"})
+            return
+        except ValueError as e:
+            logger.error(f"JSON decode error: {str(e)}")
+            yield sse_event({"error": True, "response": "Invalid JSON response from Groq API"})
+            return
+        yield SSE_DONE
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream', headers=SSE_HEADERS)
+
 if __name__ == '__main__':
     # Run the Flask app
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    app.run(debug=True, host='0.0.0.0', port=5000, threaded=True)
\ No newline at end of file
@@ -1,12 +1,28 @@
+import asyncio
+from contextlib import asynccontextmanager, suppress
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from routes.userRoute import router as auth_router
+from fastapi.middleware.gzip import GZipMiddleware
+from routes.userRoute import router as user_router
 from routes.patientRoute import router as patient_router
 from dotenv import load_dotenv
-from routes.chatRoute import router as chat_router
+from routes.chatRoute import router as chat_router, open_groq_client, close_groq_client, purge_chat_sessions
 from routes.brainRoute import router as brain_router
+from utils.compression import COMPRESS_MIN_SIZE, GZIP_LEVEL, StreamingPassthroughMiddleware
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One pooled HTTP client for outbound Groq calls, for the lifetime of the app
+    open_groq_client()
+    # Expired chat sessions are swept on a timer rather than on the request path
+    purge_task = asyncio.create_task(purge_chat_sessions())
+    yield
+    purge_task.cancel()
+    with suppress(asyncio.CancelledError):
+        await purge_task
+    await close_groq_client()
+
+app = FastAPI(lifespan=lifespan)
 
 # Setup CORS
 app.add_middleware(
@@ -17,6 +33,13 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compress dynamic responses above COMPRESS_MIN_SIZE. Responses that already carry a
+# Content-Encoding (pre-compressed brain data) are passed through untouched, and streaming
+# responses (server-sent events) are marked identity first so they are never buffered;
+# add_middleware wraps outward, so the passthrough runs inside the gzip layer
+app.add_middleware(StreamingPassthroughMiddleware)
+app.add_middleware(GZipMiddleware, minimum_size=COMPRESS_MIN_SIZE, compresslevel=GZIP_LEVEL)
+
 # Register routers
 app.include_router(user_router, prefix="/api/users", tags=["users"])
 app.include_router(patient_router, prefix="/api")
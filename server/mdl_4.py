@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 import pandas as pd
 import random
 
@@ -131,76 +132,153 @@ class Net(nn.Module):
             print("Warning: Using fallback forward method. This should not happen with the loaded model.")
             return x
     
-    def predict(self, dataframe):
+    def _forward_features(self, x):
+        """Run a batch through backbone, global_pool and head."""
+        x = self.backbone(x)
+
+        if hasattr(self, 'global_pool') and callable(self.global_pool):
+            x = self.global_pool(x)
+
+        if hasattr(self, 'head') and callable(self.head):
+            x = self.head(x)
+
+        return x
+
+    def predict_batch(self, recordings, window=250, stride=250, batch_size=32):
         """
-        Make predictions on a pandas DataFrame containing EEG data
+        Run deterministic sliding-window inference over several recordings at once
+
+        Windows from all recordings are packed into shared mini-batches, so many
+        short recordings cost as few forward passes as one long one. Recordings
+        are grouped by channel count so every mini-batch has a uniform shape.
 
         Args:
-            dataframe: pandas DataFrame with EEG channel data
+            recordings: list of numpy arrays of shape (channels, time_points)
+            window: window length in samples
+            stride: step between consecutive window starts in samples
+            batch_size: number of windows per forward pass
 
         Returns:
-            numpy array with predictions [eeg_id, lpd_vote, gpd_vote, lrda_vote, grda_vote, other_vote]
+            list with, for each recording, a dict with 'mean' and 'max' over
+            windows, the per-window 'timeline' of outputs and the window 'starts'
+            in samples, or None if the recording is shorter than one window
         """
-        try:
-            # Handle empty dataframe case
-            if dataframe.empty or dataframe.shape[0] == 0:
-                print("Warning: Empty dataframe received")
-                return np.array([1, 0.3, 0.2, 0.7, 0.4, 0.6])
+        # Zero-copy (channels, n_windows, window) views, strided to the requested step
+        views = []
+        for data in recordings:
+            data = self._as_channel_matrix(data)
+            if data.shape[1] < window:
+                views.append(None)
+            else:
+                views.append(sliding_window_view(data, window, axis=1)[:, ::stride])
 
-            # Print dataframe info for debugging
-            print(f"DataFrame info: shape={dataframe.shape}, dtypes={dataframe.dtypes}")
+        groups = {}
+        for i, view in enumerate(views):
+            if view is not None:
+                groups.setdefault(view.shape[0], []).append(i)
 
-            # Convert all columns to numeric, coercing errors to NaN
-            dataframe = dataframe.apply(pd.to_numeric, errors='coerce')
+        results = [None] * len(views)
+        for indices in groups.values():
+            # (recording, window) pairs in order across every recording in the group
+            pairs = [(i, w) for i in indices for w in range(views[i].shape[1])]
+            outputs = {i: [] for i in indices}
 
-            # Fill NaN values with 0
-            dataframe.fillna(0, inplace=True)
+            for batch_start in range(0, len(pairs), batch_size):
+                batch_pairs = pairs[batch_start:batch_start + batch_size]
+                # Only the current mini-batch is materialised: (batch, channels, window)
+                batch = np.stack([views[i][:, w] for i, w in batch_pairs])
+                # The backbone expects 3 input channels; expand without copying
+                input_tensor = torch.from_numpy(batch).unsqueeze(1).expand(-1, 3, -1, -1)
+                batch_output = self._forward_features(input_tensor).detach().cpu().numpy()
+                for (i, _), row in zip(batch_pairs, batch_output.reshape(len(batch_pairs), -1)):
+                    outputs[i].append(row)
 
-            # Reshape data for CNN processing
-            time_points, channels = dataframe.shape
-            print(f"Original data shape: time_points={time_points}, channels={channels}")
+            for i in indices:
+                timeline = np.stack(outputs[i])
+                results[i] = {
+                    "mean": timeline.mean(axis=0),
+                    "max": timeline.max(axis=0),
+                    "timeline": timeline,
+                    "starts": np.arange(len(timeline)) * stride,
+                }
 
-            # Define segment parameters
-            segment_length = 250
-            num_segments = 10
+        return results
 
-            if time_points < segment_length * num_segments:
-                print("Error: Insufficient data for segmentation")
-                return np.array([1, 0.3, 0.2, 0.7, 0.4, 0.6])
+    def predict_windows(self, data, window=250, stride=250, batch_size=32):
+        """
+        Run deterministic sliding-window inference over an entire recording
 
-            # Select random segments
-            selected_segments = []
-            for _ in range(num_segments):
-                start_idx = random.randint(0, time_points - segment_length)
-                selected_segments.append(dataframe.iloc[start_idx:start_idx + segment_length].values)
+        Args:
+            data: numpy array of shape (channels, time_points)
+            window: window length in samples
+            stride: step between consecutive window starts in samples
+            batch_size: number of windows per forward pass
 
-            # Adjust reshaping to match the model's expected input dimensions
-            # Assuming the model expects (batch_size, channels, height, width)
-            reshaped_data = np.stack(selected_segments, axis=0).transpose(0, 2, 1)
-            print(f"Adjusted reshaped data tensor size: {reshaped_data.shape}")
+        Returns:
+            dict with 'mean' and 'max' over windows, the per-window 'timeline'
+            of outputs and the window 'starts' in samples, or None if the
+            recording is shorter than one window
+        """
+        return self.predict_batch([data], window=window, stride=stride, batch_size=batch_size)[0]
 
-            # Ensure the input tensor has 3 channels by duplicating the single channel
-            reshaped_data = np.repeat(reshaped_data[:, np.newaxis, :, :], 3, axis=1)
-            print(f"Final reshaped data tensor size with 3 channels: {reshaped_data.shape}")
+    @staticmethod
+    def _as_channel_matrix(data):
+        """
+        Coerce model input to a contiguous float32 (channels, time_points) matrix
 
-            # Convert to torch tensor with correct dimensions
-            input_tensor = torch.tensor(reshaped_data, dtype=torch.float32)
+        NumPy arrays are taken as (channels, time_points), as returned by MNE's
+        raw.get_data(); DataFrames are taken as (time_points, channels) with one
+        column per channel.
+        """
+        if isinstance(data, pd.DataFrame):
+            # Convert all columns to numeric, coercing errors to NaN
+            data = data.apply(pd.to_numeric, errors='coerce').to_numpy(dtype=np.float32).T
+        data = np.ascontiguousarray(data, dtype=np.float32)
+        if data.ndim != 2:
+            raise ValueError(f"Expected a 2D (channels, time_points) array, got shape {data.shape}")
+        # Replace NaN values with 0, copying only when there is something to replace
+        if np.isnan(data).any():
+            data = np.nan_to_num(data, nan=0.0)
+        return data
 
-            # Pass through the model
-            if hasattr(self, 'backbone') and callable(self.backbone):
-                x = self.backbone(input_tensor)
+    def predict(self, data, window=250, stride=250, batch_size=32):
+        """
+        Make predictions on EEG data
 
-                if hasattr(self, 'global_pool') and callable(self.global_pool):
-                    x = self.global_pool(x)
+        Args:
+            data: numpy array of shape (channels, time_points), or a pandas
+                DataFrame with one column per EEG channel
+            window: window length in samples
+            stride: step between consecutive window starts in samples
+            batch_size: number of windows per forward pass
 
-                if hasattr(self, 'head') and callable(self.head):
-                    x = self.head(x)
+        Returns:
+            numpy array with predictions [eeg_id, lpd_vote, gpd_vote, lrda_vote, grda_vote, other_vote]
+            averaged over every window of the recording
+        """
+        try:
+            data = self._as_channel_matrix(data)
 
-                return x.detach().numpy()
-            else:
+            # Handle empty input case
+            if data.size == 0:
+                print("Warning: Empty EEG data received")
+                return np.array([1, 0.3, 0.2, 0.7, 0.4, 0.6])
+
+            channels, time_points = data.shape
+            print(f"Original data shape: time_points={time_points}, channels={channels}")
+
+            if not (hasattr(self, 'backbone') and callable(self.backbone)):
                 print("Error: Model backbone or head not defined")
                 return np.array([1, 0.3, 0.2, 0.7, 0.4, 0.6])
 
+            result = self.predict_windows(data, window=window, stride=stride, batch_size=batch_size)
+            if result is None:
+                print("Error: Insufficient data for segmentation")
+                return np.array([1, 0.3, 0.2, 0.7, 0.4, 0.6])
+
+            print(f"Ran inference over {len(result['starts'])} windows")
+            return result["mean"]
+
         except Exception as e:
             print(f"Error during prediction: {e}")
             return np.array([1, 0.3, 0.2, 0.7, 0.4, 0.6])
@@ -1,3 +1,4 @@
 from .userModel import userReqMod,userResMod
 from .patientModel import Patient 
-from .chatModel import ChatRequestModel,ChatResponseModel
\ No newline at end of file
+from .chatModel import ChatRequestModel,ChatResponseModel
+from .brainModel import BrainGenerateRequest
\ No newline at end of file
@@ -0,0 +1,4 @@
+from pydantic import BaseModel
+
+class BrainGenerateRequest(BaseModel):
+    patient_id: str
\ No newline at end of file
@@ -1,47 +1,289 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import FileResponse, JSONResponse, Response
+from typing import Optional
 import os
 import json
+import hashlib
+import threading
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+import numpy as np
+from models import BrainGenerateRequest
+from utils.jobs import JobManager
+from utils.brain import BRAIN_STAGES, generate_patient_brain_data, lod_bundle_path, patient_output_dir
+from utils.recordings import recording_path
+from utils import brain_bundle
+from utils.compression import SUFFIXES, available_encodings, compress, negotiate_encoding, precompressed_path
 
 router = APIRouter()
 
+# Source-estimate generation is memory heavy, so it runs on its own small process pool
+brain_job_manager = JobManager(
+    max_workers=int(os.getenv("BRAIN_JOB_WORKERS", "1")),
+    stages=BRAIN_STAGES
+)
+
+# Serialized brain payloads kept in memory, invalidated when the underlying file changes
+BRAIN_PAYLOAD_CACHE_SIZE = int(os.getenv("BRAIN_PAYLOAD_CACHE_SIZE", "8"))
+_payload_cache = OrderedDict()
+_payload_lock = threading.Lock()
+
+def brain_data_path(patient_id: Optional[str] = None, ext: str = 'json') -> str:
+    """Path of a patient's brain data, or of the shared demo brain when no patient is given."""
+    if patient_id:
+        return os.path.join(patient_output_dir(patient_id), f'brain_data.{ext}')
+    return os.path.join(os.path.dirname(os.path.dirname(__file__)), 'utils', f'brain_data.{ext}')
+
+def bundle_to_json(meta: dict, arrays: dict) -> dict:
+    """Legacy JSON payload built from bundle arrays, for clients that cannot read the bundle."""
+    activation_data = arrays['activation_data']
+    if meta.get('activation_layout') == 'time_major':
+        activation_data = activation_data.T
+    data = {
+        'time_info': dict(meta['time_info'], times=arrays['times'].tolist()),
+        'activation_data': activation_data.tolist()
+    }
+    # Mesh arrays are absent when a selection was requested without the mesh
+    for name in ('vertices', 'faces', 'source_index', 'activation_scale', 'activation_offset'):
+        if name in arrays:
+            data[name] = arrays[name].tolist()
+    if 'activation_encoding' in meta:
+        data['activation_encoding'] = dict(meta['activation_encoding'], layout='source_major')
+    return data
+
+def slice_brain_bundle(bundle_path: str, t_start: Optional[float], t_stop: Optional[float],
+                       step: int, hemi: str, mesh: bool, lod: Optional[int] = None):
+    """
+    Select a time window, every step-th time point and one or both hemispheres from a
+    memory-mapped bundle. Returns (meta, arrays); only the selected bytes are read.
+    lod picks one of the bundle's decimated meshes (0 is the coarsest) instead of the full one.
+    """
+    meta, arrays = brain_bundle.load_arrays(bundle_path)
+    times = arrays['times']
+    # Compare in the stored precision so a bound equal to a sample time includes that sample
+    first = 0 if t_start is None else int(np.searchsorted(times, times.dtype.type(t_start), side='left'))
+    last = len(times) if t_stop is None else int(np.searchsorted(times, times.dtype.type(t_stop), side='right'))
+    time_index = slice(first, last, step)
+
+    n_sources = arrays['activation_data'].shape[1]
+    ranges = meta.get('hemispheres', {}).get(hemi) if hemi != 'both' else None
+    if hemi != 'both' and ranges is None:
+        raise HTTPException(status_code=400, detail="Hemisphere selection is not available for this brain data")
+    sources = slice(*ranges['sources']) if ranges else slice(0, n_sources)
+
+    selected_times = np.array(times[time_index])
+    selection = {
+        'times': selected_times,
+        'activation_data': np.ascontiguousarray(arrays['activation_data'][time_index, sources])
+    }
+
+    lod_levels = meta.get('lod_levels', [])
+    if lod is not None and lod >= len(lod_levels):
+        lod = None
+    if mesh:
+        mesh_ranges = ranges
+        if lod is not None:
+            lod_meta, arrays = brain_bundle.load_arrays(lod_bundle_path(bundle_path, lod))
+            mesh_ranges = lod_meta['hemispheres'].get(hemi) if ranges else None
+        vertex_range = mesh_ranges['vertices'] if mesh_ranges else [0, len(arrays['vertices'])]
+        face_range = mesh_ranges['faces'] if mesh_ranges else [0, len(arrays['faces'])]
+        selection['vertices'] = np.array(arrays['vertices'][slice(*vertex_range)])
+        # Re-base face indices onto the selected vertices
+        selection['faces'] = np.array(arrays['faces'][slice(*face_range)]) - vertex_range[0]
+        if 'source_index' in arrays:
+            # ... and source indices onto the selected activation columns
+            selection['source_index'] = np.array(arrays['source_index'][slice(*vertex_range)]) - sources.start
+
+    time_info = dict(meta['time_info'], time_step=meta['time_info']['time_step'] * step)
+    if len(selected_times):
+        time_info.update(min_time=float(selected_times[0]), max_time=float(selected_times[-1]))
+    selected_meta = dict(
+        meta,
+        time_info=time_info,
+        selection={
+            'hemi': hemi, 'step': step, 'time_index': [first, last], 'sources': [sources.start, sources.stop],
+            # Level of the returned mesh; len(lod_levels) is the full-resolution mesh
+            'lod': len(lod_levels) if lod is None else lod
+        }
+    )
+    selected_meta.pop('hemispheres', None)
+    return selected_meta, selection
+
+def file_validators(path: str):
+    """Strong ETag and Last-Modified for a file, derived from its mtime and size."""
+    stat = os.stat(path)
+    etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    return etag, formatdate(stat.st_mtime, usegmt=True), (stat.st_mtime_ns, stat.st_size)
+
+def is_not_modified(request: Request, etag: str, last_modified: str) -> bool:
+    """True if the client's cached copy (If-None-Match / If-Modified-Since) is still current."""
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        return etag in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == '*'
+    if_modified_since = request.headers.get('if-modified-since')
+    if if_modified_since is not None:
+        try:
+            return parsedate_to_datetime(if_modified_since) >= parsedate_to_datetime(last_modified)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def cached_payload(path: str, variant: str, build) -> bytes:
+    """
+    Serialized payload for a file, built once with build(path) and kept in memory until
+    the file's mtime or size changes. variant distinguishes payloads built from the same file.
+    """
+    _, _, stat_key = file_validators(path)
+    key = (path, variant)
+    with _payload_lock:
+        entry = _payload_cache.get(key)
+        if entry is not None and entry[0] == stat_key:
+            _payload_cache.move_to_end(key)
+            return entry[1]
+
+    payload = build(path)
+    with _payload_lock:
+        _payload_cache[key] = (stat_key, payload)
+        _payload_cache.move_to_end(key)
+        while len(_payload_cache) > BRAIN_PAYLOAD_CACHE_SIZE:
+            _payload_cache.popitem(last=False)
+    return payload
+
+def read_bytes(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
 @router.get('/data')
-def get_brain_data():
+def get_brain_data(request: Request, patient_id: Optional[str] = None, format: str = 'json',
+                   t_start: Optional[float] = None, t_stop: Optional[float] = None,
+                   step: int = 1, hemi: str = 'both', mesh: bool = True, lod: Optional[int] = None,
+                   quantize: Optional[int] = None, delta: bool = True):
     """
     Send brain data generated from MNE Python for 3D visualization.
-    Returns the brain data as JSON.
+    Returns the given patient's brain data, or the demo brain when no patient_id is given.
+    format=bin serves the binary bundle (see utils/brain_bundle.py) as raw bytes;
+    format=json returns the legacy JSON payload.
+
+    t_start/t_stop (seconds) select a time window, step keeps every step-th time point,
+    hemi ('lh', 'rh' or 'both') selects vertices and mesh=false omits the mesh, so a
+    viewer scrubbing the timeline only downloads the activations it displays.
+
+    lod selects a decimated mesh, 0 being the coarsest, so a viewer can render lod=0
+    first and fetch finer levels afterwards; values past the last level return the full
+    mesh. Meshes come with source_index mapping each vertex to its activation column.
+
+    quantize=8 or 16 sends activations as per-frame quantized codes, delta-coded along
+    time unless delta=false; see utils/brain_bundle.py for how to decode them.
+
+    Responses carry a strong ETag and Last-Modified; conditional requests that match
+    get a 304 without the payload being read or serialized.
     """
     try:
-        # Path to the brain data JSON file
-        data_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'utils', 'brain_data.json')
-        
-        if not os.path.exists(data_path):
+        if format not in ('json', 'bin'):
+            raise HTTPException(status_code=400, detail="format must be 'json' or 'bin'")
+        if step < 1 or hemi not in ('lh', 'rh', 'both'):
+            raise HTTPException(status_code=400, detail="step must be >= 1 and hemi one of 'lh', 'rh', 'both'")
+        if lod is not None and lod < 0:
+            raise HTTPException(status_code=400, detail="lod must be >= 0")
+        if quantize is not None and quantize not in brain_bundle.QUANTIZED_DTYPES:
+            raise HTTPException(status_code=400, detail="quantize must be 8 or 16")
+
+        bundle_path = brain_data_path(patient_id, 'bin')
+        sliced = t_start is not None or t_stop is not None or step != 1 or hemi != 'both' or not mesh or lod is not None or quantize is not None
+
+        # Serve the JSON file's bytes as-is when there is one; otherwise everything comes from the bundle
+        data_path = brain_data_path(patient_id)
+        if format == 'json' and not sliced and os.path.exists(data_path):
+            source_path = data_path
+        elif os.path.exists(bundle_path):
+            source_path = bundle_path
+        else:
             raise HTTPException(status_code=404, detail="Brain data not found")
-            
-        with open(data_path, 'r') as f:
-            data = json.load(f)
-            
-        return data
+
+        etag, last_modified, _ = file_validators(source_path)
+        if sliced:
+            # Each selection of the same file gets its own validator
+            selection = f"{format}:{t_start}:{t_stop}:{step}:{hemi}:{mesh}:{lod}:{quantize}:{delta}"
+            etag = f'"{etag.strip(chr(34))}-{hashlib.sha1(selection.encode()).hexdigest()[:12]}"'
+        elif format == 'json' and source_path == bundle_path:
+            etag = f'"{etag.strip(chr(34))}-json"'
+
+        headers = {'ETag': etag, 'Last-Modified': last_modified, 'Cache-Control': 'no-cache'}
+
+        if sliced:
+            if is_not_modified(request, etag, last_modified):
+                return Response(status_code=304, headers=headers)
+            meta, arrays = slice_brain_bundle(bundle_path, t_start, t_stop, step, hemi, mesh, lod)
+            if quantize:
+                quantized, meta['activation_encoding'] = brain_bundle.quantize_activations(arrays['activation_data'], quantize, delta)
+                arrays.update(quantized)
+            if format == 'bin':
+                return Response(content=brain_bundle.encode_bundle(arrays, meta), media_type=brain_bundle.MEDIA_TYPE, headers=headers)
+            data = bundle_to_json(meta, arrays)
+            data['selection'] = meta['selection']
+            return JSONResponse(content=data, headers=headers)
+
+        # Whole payloads go out as the .br/.gz artifact written at export time when there is
+        # a fresh one. JSON built from the bundle has none, so it is gzipped once and kept in
+        # memory. Anything else is left to GZipMiddleware.
+        media_type = brain_bundle.MEDIA_TYPE if format == 'bin' else 'application/json'
+        from_bundle = format == 'json' and source_path == bundle_path
+        encoding = negotiate_encoding(
+            request.headers.get('accept-encoding'),
+            ['gzip'] if from_bundle else [e for e in available_encodings() if precompressed_path(source_path, e)]
+        )
+        headers['Vary'] = 'Accept-Encoding'
+        if encoding:
+            headers['ETag'] = etag = f'"{etag.strip(chr(34))}-{encoding}"'
+        if is_not_modified(request, etag, last_modified):
+            return Response(status_code=304, headers=headers)
+        if encoding:
+            headers['Content-Encoding'] = encoding
+
+        if not from_bundle:
+            if encoding:
+                return FileResponse(source_path + SUFFIXES[encoding], media_type=media_type, headers=headers)
+            if format == 'bin':
+                return FileResponse(bundle_path, media_type=media_type, headers=headers)
+            return Response(content=cached_payload(data_path, 'json', read_bytes), media_type=media_type, headers=headers)
+
+        build_json = lambda path: json.dumps(bundle_to_json(*brain_bundle.load_arrays(path))).encode('utf-8')
+        if encoding:
+            content = cached_payload(bundle_path, 'json.gzip', lambda path: compress(cached_payload(path, 'json', build_json), 'gzip'))
+        else:
+            content = cached_payload(bundle_path, 'json', build_json)
+        return Response(content=content, media_type=media_type, headers=headers)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         if isinstance(e, HTTPException):
             raise e
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.post('/generate')
-def generate_brain_data():
+def generate_brain_data(req: BrainGenerateRequest):
     """
-    Trigger regeneration of brain data (for future use).
-    Currently just returns existing data.
+    Start source-estimate generation from a patient's uploaded recording.
+    Runs in the background; poll /generate/{job_id} for progress.
     """
     try:
-        # TODO: In the future, this could trigger regeneration with custom parameters
-        # For now, just return the existing brain data
-        data_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'utils', 'brain_data.json')
-        
-        if not os.path.exists(data_path):
-            raise HTTPException(status_code=404, detail="Brain data not found")
-            
-        return {"message": "Using existing brain data", "data_path": data_path}
+        recording_file = recording_path(req.patient_id)
+        if not os.path.exists(recording_file):
+            raise HTTPException(status_code=404, detail="No EEG recording uploaded for this patient")
+
+        job_id = brain_job_manager.submit(generate_patient_brain_data, recording_file, req.patient_id)
+        return {"message": "Brain data generation started", "job_id": job_id, "status": "queued"}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         if isinstance(e, HTTPException):
             raise e
         raise HTTPException(status_code=500, detail=str(e))
+
+@router.get('/generate/{job_id}')
+def get_brain_generation_status(job_id: str):
+    """Report the progress of a brain data generation job."""
+    job = brain_job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
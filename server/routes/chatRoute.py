@@ -1,30 +1,117 @@
 from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from models import ChatRequestModel, ChatResponseModel
-import requests
+from utils.sse import SSE_DONE, SSE_HEADERS, parse_stream_line, sse_event
+from utils.chat_context import compact_messages
+from utils.chat_sessions import (
+    CHAT_SESSION_DIR, CHAT_SESSION_MAX, CHAT_SESSION_PURGE_INTERVAL, CHAT_SESSION_TTL, ChatSessionStore
+)
+from typing import Optional
+import asyncio
+import httpx
 import os
 import logging
 
 router = APIRouter()
 
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
-GROQ_API_URL = "https://api.groq.com/openai/v1/chat/completions"  # Update this URL
+GROQ_API_URL = os.getenv("GROQ_API_URL", "https://api.groq.com/openai/v1/chat/completions")  # Override to point at a local stub
 GROQ_MODEL = "llama-3.3-70b-versatile"  # Add this model
+# Groq calls must not hang a request indefinitely
+GROQ_CONNECT_TIMEOUT = float(os.getenv("GROQ_CONNECT_TIMEOUT", "5"))
+GROQ_TIMEOUT = float(os.getenv("GROQ_TIMEOUT", "60"))
+# Connection pool shared by all chat requests
+GROQ_MAX_CONNECTIONS = int(os.getenv("GROQ_MAX_CONNECTIONS", "20"))
+GROQ_MAX_KEEPALIVE = int(os.getenv("GROQ_MAX_KEEPALIVE", "10"))
 
-@router.post("/chatbot")
-async def chatbot(req: dict):
-    # Extract data from request
-    alpha_context = req.get("alphaContext", "")
-    conversation = req.get("conversation", [])
+# Opened at app startup and closed at shutdown (see main.py)
+groq_client: Optional[httpx.AsyncClient] = None
+
+def open_groq_client() -> httpx.AsyncClient:
+    """Create the shared keep-alive client used for Groq calls."""
+    global groq_client
+    if groq_client is None or groq_client.is_closed:
+        groq_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(GROQ_TIMEOUT, connect=GROQ_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=GROQ_MAX_CONNECTIONS, max_keepalive_connections=GROQ_MAX_KEEPALIVE)
+        )
+    return groq_client
+
+async def close_groq_client():
+    global groq_client
+    if groq_client is not None:
+        await groq_client.aclose()
+        groq_client = None
+
+SYSTEM_PROMPT = "You are being used as a AI chatbot for an EEG signal analyser. The main context you are receving is the content analysed from the EEG signal. You will also receive the context of the entire conversation you have with the user. Help the user with whatever he wants. Be concise, dont go deep unless the user asks you to. Context (if any): {context}. "
+
+# Session store calls do file I/O, so routes run them in the thread pool
+chat_sessions = ChatSessionStore(max_sessions=CHAT_SESSION_MAX, ttl=CHAT_SESSION_TTL, directory=CHAT_SESSION_DIR)
+
+async def purge_chat_sessions():
+    """Background task (started in main.py): drop expired sessions every CHAT_SESSION_PURGE_INTERVAL seconds."""
+    while True:
+        await asyncio.sleep(CHAT_SESSION_PURGE_INTERVAL)
+        try:
+            await run_in_threadpool(chat_sessions.purge_expired)
+        except Exception as e:
+            logging.error(f"Failed to purge chat sessions: {str(e)}")
+
+async def build_messages(req: dict):
+    """
+    Chat history for Groq: the system prompt with the EEG context, the conversation so far
+    and the new message, compacted to the CHAT_CONTEXT_TOKENS budget (see utils/chat_context.py).
+    With a sessionId the context and conversation come from the server-side session;
+    otherwise from the request. Returns (messages, session), session being None without one.
+    """
     new_message = req.get("newMessage", "")
+    session_id = req.get("sessionId")
+    if session_id:
+        session = await run_in_threadpool(chat_sessions.get, session_id)
+        if session is None:
+            raise HTTPException(status_code=404, detail="Chat session not found or expired")
+        alpha_context = req.get("alphaContext") or session["alpha_context"]
+        conversation = session["conversation"]
+    else:
+        session = None
+        alpha_context = req.get("alphaContext", "")
+        conversation = req.get("conversation", [])
+    return compact_messages(SYSTEM_PROMPT, alpha_context, conversation, new_message), session
+
+async def remember_turn(session, req: dict, answer: str):
+    """Store the new message and its answer in the session, if the request used one."""
+    if session is None:
+        return
+    await run_in_threadpool(chat_sessions.append, session["id"], [
+        {"role": "user", "content": req.get("newMessage", "")},
+        {"role": "assistant", "content": answer}
+    ], alpha_context=req.get("alphaContext") or None)
+
+@router.post("/sessions")
+async def create_chat_session(req: dict):
+    """
+    Start a server-side conversation holding the EEG analysis context. Chat requests that
+    pass the returned sessionId only need to send newMessage.
+    """
+    session = await run_in_threadpool(chat_sessions.create, req.get("alphaContext", ""))
+    return {"error": False, "sessionId": session["id"]}
+
+@router.get("/sessions/{session_id}")
+async def get_chat_session(session_id: str):
+    session = await run_in_threadpool(chat_sessions.get, session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Chat session not found or expired")
+    return {"error": False, "sessionId": session["id"], "alphaContext": session["alpha_context"], "conversation": session["conversation"]}
 
-    full_messages = [{
-        "role": "system",
-        "content": f"You are being used as a AI chatbot for an EEG signal analyser. The main context you are receving is the content analysed from the EEG signal. You will also receive the context of the entire conversation you have with the user. Help the user with whatever he wants. Be concise, dont go deep unless the user asks you to. Context (if any): {alpha_context}. "
-    }]
-    for msg in conversation:
-        # msg is dict with 'role' and 'content'
-        full_messages.append(msg)
-    full_messages.append({"role": "user", "content": new_message})
+@router.delete("/sessions/{session_id}")
+async def delete_chat_session(session_id: str):
+    await run_in_threadpool(chat_sessions.delete, session_id)
+    return {"error": False}
+
+@router.post("/chatbot")
+async def chatbot(req: dict):
+    full_messages, session = await build_messages(req)
 
     if not GROQ_API_KEY:
         raise HTTPException(status_code=500, detail="GROQ_API_KEY is not set")
@@ -39,7 +126,15 @@ async def chatbot(req: dict):
     }
     
     logging.info(f"Sending request to Groq API: {payload}")
-    response = requests.post(GROQ_API_URL, headers=headers, json=payload)
+    try:
+        # Awaiting keeps the event loop free for other requests while the answer is generated
+        response = await open_groq_client().post(GROQ_API_URL, headers=headers, json=payload)
+    except httpx.TimeoutException:
+        logging.error(f"Groq API call timed out after {GROQ_TIMEOUT}s")
+        raise HTTPException(status_code=504, detail="Groq API timed out")
+    except httpx.HTTPError as e:
+        logging.error(f"Groq API request failed: {str(e)}")
+        raise HTTPException(status_code=502, detail="Failed to reach Groq API")
     
     if response.status_code != 200:
         logging.error(f"Failed to get response from Groq API: {response.text}")
@@ -54,4 +149,59 @@ async def chatbot(req: dict):
     logging.info(f"Received response from Groq API: {data}")
     if "choices" not in data or not data["choices"]:
         raise HTTPException(status_code=500, detail="Invalid response structure from Groq API")
-    return {"error": False, "response": data["choices"][0]["message"]["content"]}
\ No newline at end of file
+    answer = data["choices"][0]["message"]["content"]
+    await remember_turn(session, req, answer)
+    if session is not None:
+        return {"error": False, "response": answer, "sessionId": session["id"]}
+    return {"error": False, "response": answer}
+
+@router.post("/chatbot/stream")
+async def chatbot_stream(req: dict):
+    """
+    Same conversation as /chatbot (including sessionId), but the answer is forwarded as server-sent events while
+    Groq generates it: one {"token": ...} event per chunk, then [DONE]. Failures after the
+    stream has started arrive as an {"error": true, "response": ...} event.
+    """
+    if not GROQ_API_KEY:
+        raise HTTPException(status_code=500, detail="GROQ_API_KEY is not set")
+
+    full_messages, session = await build_messages(req)
+    headers = {
+        "Authorization": f"Bearer {GROQ_API_KEY}",
+        "Content-Type": "application/json"
+    }
+    payload = {
+        "model": GROQ_MODEL,
+        "messages": full_messages,
+        "stream": True
+    }
+
+    async def events():
+        tokens = []
+        try:
+            async with open_groq_client().stream("POST", GROQ_API_URL, headers=headers, json=payload) as response:
+                if response.status_code != 200:
+                    body = await response.aread()
+                    logging.error(f"Failed to get response from Groq API: {body.decode(errors='replace')}")
+                    yield sse_event({"error": True, "response": "Failed to get response from Groq API"})
+                    return
+                async for line in response.aiter_lines():
+                    token = parse_stream_line(line)
+                    if token is None:
+                        break
+                    if token:
+                        tokens.append(token)
+                        yield sse_event({"token": token})
+        except httpx.TimeoutException:
+            logging.error(f"Groq API stream timed out after {GROQ_TIMEOUT}s")
+            yield sse_event({"error": True, "response": "Groq API timed out"})
+            return
+        except (httpx.HTTPError, ValueError) as e:
+            logging.error(f"Groq API stream failed: {str(e)}")
+            yield sse_event({"error": True, "response": "Failed to get response from Groq API"})
+            return
+        # Only complete answers become part of the session's history
+        await remember_turn(session, req, "".join(tokens))
+        yield SSE_DONE
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
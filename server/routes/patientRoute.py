@@ -5,6 +5,9 @@ import uuid
 from pydantic import BaseModel
 from typing import List, Optional
 from models.patientModel import Patient
+from utils.jobs import JobManager
+from utils.analysis_jobs import PIPELINE_STAGES, init_worker, analyze_patients
+from utils.recordings import has_recording
 
 router = APIRouter()
 
@@ -20,6 +23,34 @@ service_supabase = None
 if SUPABASE_SERVICE_KEY:
     service_supabase: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
 
+# Background EEG analysis jobs, run on a bounded process pool
+job_manager = JobManager(
+    max_workers=int(os.getenv("EEG_JOB_WORKERS", "2")),
+    initializer=init_worker,
+    stages=PIPELINE_STAGES
+)
+
+def save_batch_analysis(job: dict, user_id: str) -> None:
+    """Write each patient's finished analysis back to the fields save_patient_analysis updates"""
+    if job["status"] != "completed":
+        return
+
+    client = service_supabase if service_supabase else supabase
+    for patient_id, outcome in job["result"].items():
+        result = outcome["result"]
+        if result is None:
+            print(f"EEG analysis failed for patient {patient_id}: {outcome['error']}")
+            continue
+        try:
+            client.table("patients").update({
+                "raw_predictions": result["raw"],
+                "condition_probabilities": result["percentage"],
+                "medication": result["medication"],
+                "ai_content": result["ai_content"]
+            }).eq("id", patient_id).eq("uid", user_id).execute()
+        except Exception as e:
+            print(f"Error saving EEG analysis for patient {patient_id}: {str(e)}")
+
 class PatientResponse(BaseModel):
     error: bool
     data: Optional[List[Patient]] = None
@@ -111,16 +142,24 @@ async def analyze_multiple_patients_eeg(request: EegAnalysisRequest):
             if not patient_response.data or len(patient_response.data) == 0:
                 return {"error": True, "message": f"Patient with ID {patient_id} not found or does not belong to the user"}
         
-        # In a real implementation, this would initiate EEG analysis for each patient
-        # For now, we'll just return a success message with the patients that would be analyzed
-        
+        # Every patient needs an uploaded recording to analyze
+        missing = [patient_id for patient_id in request.patient_ids if not has_recording(patient_id)]
+        if missing:
+            return {"error": True, "message": f"No EEG recording uploaded for patients: {', '.join(missing)}"}
+
+        # Run the analysis in the background; the caller polls the job for progress and results
+        analysis_id = job_manager.submit(
+            analyze_patients, request.patient_ids,
+            on_done=lambda job: save_batch_analysis(job, request.user_id)
+        )
+
         return {
             "error": False, 
             "data": {
-                "analysis_id": "eeg-analysis-123", # This would be a real ID in production
+                "analysis_id": analysis_id,
                 "patient_ids": request.patient_ids,
                 "analysis_type": request.analysis_type,
-                "status": "processing"
+                "status": "queued"
             },
             "message": f"EEG analysis started for {len(request.patient_ids)} patients"
         }
@@ -128,6 +167,21 @@ async def analyze_multiple_patients_eeg(request: EegAnalysisRequest):
         print(f"Error analyzing patients' EEG data: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
+@router.get("/patients/analyze-eeg/{analysis_id}", response_model=EegAnalysisResponse)
+async def get_eeg_analysis_status(analysis_id: str):
+    """Get the progress and, once finished, the results of an EEG analysis job"""
+    try:
+        job = job_manager.get(analysis_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Analysis not found")
+
+        return {"error": False, "data": job, "message": f"Analysis is {job['status']}"}
+    except Exception as e:
+        print(f"Error retrieving EEG analysis status: {str(e)}")
+        if isinstance(e, HTTPException):
+            raise e
+        raise HTTPException(status_code=500, detail="Internal server error")
+
 @router.post("/patients/save-analysis")
 async def save_patient_analysis(request: dict):
     """Save EEG analysis data for a specific patient"""
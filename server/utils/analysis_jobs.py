@@ -0,0 +1,18 @@
+# Lightweight entry points for EEG analysis jobs. The API process only needs these to
+# queue jobs; utils.pipeline (torch, mne, timm and its cache directories) is imported
+# inside the worker processes, on first use.
+
+# Stages reported through the progress callback of analyze_recording, in order
+PIPELINE_STAGES = ["preprocessing", "inference", "scoring", "llm"]
+
+
+def init_worker():
+    """Process pool initializer: load the pipeline and keep its models resident in the worker."""
+    from utils.pipeline import init_worker as init_pipeline_worker
+    init_pipeline_worker()
+
+
+def analyze_patients(patient_ids, progress=None):
+    """Job wrapper around utils.pipeline.analyze_patients."""
+    from utils.pipeline import analyze_patients as run_analysis
+    return run_analysis(patient_ids, progress=progress)
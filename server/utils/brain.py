@@ -1,15 +1,112 @@
 import mne
 from mne.datasets import fetch_fsaverage, sample
-from mne.minimum_norm import make_inverse_operator, apply_inverse
+from mne.minimum_norm import make_inverse_operator, apply_inverse, apply_inverse_raw, read_inverse_operator, write_inverse_operator
 import os.path as op
 import os
-import pyvistaqt
+import hashlib
 import numpy as np
 import json
+from utils.recordings import validate_patient_id
+from utils import brain_bundle
+from utils.compression import write_precompressed
+
+# Source space resolution used for all brain visualizations
+SPACING = 'ico4'
+# Where source spaces, forward solutions and inverse operators are persisted between runs
+BRAIN_CACHE_DIR = os.getenv(
+    "BRAIN_CACHE_DIR",
+    op.join(op.dirname(op.dirname(op.abspath(__file__))), 'cache', 'brain')
+)
+
+# Per-patient visualization artifacts, one directory per patient
+BRAIN_OUTPUT_DIR = os.getenv(
+    "BRAIN_OUTPUT_DIR",
+    op.join(op.dirname(op.dirname(op.abspath(__file__))), 'brain_data')
+)
+# Length of recording (seconds) and sampling rate (Hz) used for patient source estimates
+BRAIN_SEGMENT_SECONDS = float(os.getenv("BRAIN_SEGMENT_SECONDS", "10"))
+BRAIN_SFREQ = float(os.getenv("BRAIN_SFREQ", "50"))
+# Stages reported through the progress callback of generate_patient_brain_data, in order
+BRAIN_STAGES = ['loading', 'inverse', 'export']
+# Vertex-clustering cell sizes (metres) of the decimated meshes, coarsest first
+BRAIN_LOD_CELL_SIZES = [float(size) for size in os.getenv("BRAIN_LOD_CELL_SIZES", "0.008,0.004,0.002").split(",") if size]
+
+# Cache-key name of the covariance get_inverse_operator uses when none is given
+AD_HOC_COV = 'adhoc'
+
+def get_fsaverage():
+    """Return (fs_dir, subjects_dir) for the fsaverage template, downloading it on first use."""
+    fs_dir = fetch_fsaverage(verbose=True)
+    return fs_dir, op.dirname(fs_dir)
+
+def montage_key(info):
+    """Hash of the EEG channel set and electrode positions; forward/inverse operators depend only on these."""
+    digest = hashlib.sha256(SPACING.encode())
+    for ch in info['chs']:
+        if ch['kind'] != mne.io.constants.FIFF.FIFFV_EEG_CH or ch['ch_name'] in info['bads']:
+            continue
+        digest.update(ch['ch_name'].encode())
+        digest.update(np.round(ch['loc'][:3], 6).tobytes())
+    return digest.hexdigest()[:16]
+
+def get_source_space():
+    """Load the fsaverage source space from the cache, setting it up on first use."""
+    os.makedirs(BRAIN_CACHE_DIR, exist_ok=True)
+    src_path = op.join(BRAIN_CACHE_DIR, f'fsaverage-{SPACING}-src.fif')
+    if op.exists(src_path):
+        return mne.read_source_spaces(src_path)
+
+    _, subjects_dir = get_fsaverage()
+    src = mne.setup_source_space('fsaverage', spacing=SPACING, subjects_dir=subjects_dir)
+    mne.write_source_spaces(src_path, src, overwrite=True)
+    return src
+
+def get_forward_solution(info):
+    """Load the forward solution for this montage from the cache, computing it on first use."""
+    os.makedirs(BRAIN_CACHE_DIR, exist_ok=True)
+    fwd_path = op.join(BRAIN_CACHE_DIR, f'{montage_key(info)}-fwd.fif')
+    if op.exists(fwd_path):
+        return mne.read_forward_solution(fwd_path)
+
+    fs_dir, _ = get_fsaverage()
+    src = get_source_space()
+
+    # Load BEM solution
+    bem = mne.read_bem_solution(op.join(fs_dir, 'bem', 'fsaverage-5120-5120-5120-bem-sol.fif'))
+
+    # Create forward solution
+    fwd = mne.make_forward_solution(info, trans=None, src=src, bem=bem, eeg=True, meg=False)
+    mne.write_forward_solution(fwd_path, fwd, overwrite=True)
+    return fwd
+
+def get_inverse_operator(info, noise_cov=None, cov_kind=AD_HOC_COV):
+    """
+    Load the inverse operator for this montage and noise covariance from the cache,
+    building it on first use.
+
+    noise_cov is a callable returning the noise covariance, only invoked when the
+    operator has to be built; an ad-hoc covariance is used when it is not given.
+    cov_kind names the covariance in the cache key, so operators built from different
+    covariances are never mixed up; it is required with noise_cov.
+    """
+    if noise_cov is not None and cov_kind == AD_HOC_COV:
+        raise ValueError("cov_kind must name the covariance noise_cov computes")
+    os.makedirs(BRAIN_CACHE_DIR, exist_ok=True)
+    inv_path = op.join(BRAIN_CACHE_DIR, f'{montage_key(info)}-{cov_kind}-inv.fif')
+    if op.exists(inv_path):
+        return read_inverse_operator(inv_path)
+
+    fwd = get_forward_solution(info)
+    cov = noise_cov() if noise_cov is not None else mne.make_ad_hoc_cov(info)
+
+    # Create inverse operator
+    inverse_operator = make_inverse_operator(info, fwd, cov)
+    write_inverse_operator(inv_path, inverse_operator, overwrite=True)
+    return inverse_operator
 
 def prepare_source_data():
     """Prepare the source data for brain visualization."""
-    
+
     # Load the sample dataset
     data_path = sample.data_path()
     raw_file = data_path / 'MEG' / 'sample' / 'sample_audvis_filt-0-40_raw.fif'
@@ -28,40 +125,102 @@ def prepare_source_data():
     # Filter the data (1-40 Hz)
     raw.filter(1, 40)
 
-    # Fetch fsaverage data
-    fs_dir = fetch_fsaverage(verbose=True)
-    subjects_dir = op.dirname(fs_dir)
-
-    # Set up source space
-    src = mne.setup_source_space('fsaverage', spacing='ico4', subjects_dir=subjects_dir)
-
-    # Load BEM solution
-    bem = mne.read_bem_solution(op.join(fs_dir, 'bem', 'fsaverage-5120-5120-5120-bem-sol.fif'))
-
-    # Create forward solution
-    fwd = mne.make_forward_solution(raw.info, trans=None, src=src, bem=bem, eeg=True, meg=False)
-
     # Create epochs
     epochs = mne.Epochs(raw, events, tmin=-0.2, tmax=0.5, baseline=(None, 0), preload=True)
 
     # Compute evoked response
     evoked = epochs.average()
 
-    # Compute noise covariance
-    noise_cov = mne.compute_covariance(epochs, tmin=None, tmax=0)
-
-    # Create inverse operator
-    inverse_operator = make_inverse_operator(evoked.info, fwd, noise_cov)
+    # Source space, forward solution and inverse operator are cached per montage;
+    # the noise covariance is only computed when the inverse operator is first built
+    src = get_source_space()
+    inverse_operator = get_inverse_operator(
+        evoked.info, noise_cov=lambda: mne.compute_covariance(epochs, tmin=None, tmax=0),
+        cov_kind='sample-baseline'
+    )
 
     # Apply inverse method
     stc = apply_inverse(evoked, inverse_operator, lambda2=1.0/9.0, method='dSPM')
-    
+
     return stc, src
 
+def decimate_mesh(vertices, faces, cell_size):
+    """
+    Vertex-clustering decimation: vertices falling in the same cell_size cube are merged
+    into their centroid and faces that collapse are dropped. Returns (vertices, faces).
+    """
+    cells = np.floor((vertices - vertices.min(axis=0)) / cell_size).astype(np.int64)
+    _, cluster, counts = np.unique(cells, axis=0, return_inverse=True, return_counts=True)
+    cluster = cluster.ravel()
+
+    merged = np.zeros((len(counts), 3))
+    np.add.at(merged, cluster, vertices)
+    merged /= counts[:, None]
+
+    merged_faces = cluster[faces]
+    keep = ((merged_faces[:, 0] != merged_faces[:, 1]) &
+            (merged_faces[:, 1] != merged_faces[:, 2]) &
+            (merged_faces[:, 0] != merged_faces[:, 2]))
+    merged_faces = merged_faces[keep]
+    # Several original faces can collapse onto the same triangle
+    _, first = np.unique(np.sort(merged_faces, axis=1), axis=0, return_index=True)
+    return merged, merged_faces[np.sort(first)]
+
+def nearest_source_index(vertices, source_positions, offset=0):
+    """Index (plus offset) of the nearest source for each mesh vertex, used to colour meshes that are not the source space."""
+    from scipy.spatial import cKDTree
+    _, index = cKDTree(source_positions).query(vertices)
+    return (index + offset).astype(np.int32)
+
+def lod_bundle_path(bundle_path, level):
+    """Path of the decimated mesh bundle for a level of detail, next to the main bundle."""
+    return f"{op.splitext(bundle_path)[0]}.lod{level}.bin"
+
+def export_mesh_lods(hemi_meshes, bundle_path, cell_sizes=None):
+    """
+    Write one bundle per level of detail holding the decimated mesh (vertices, faces)
+    and source_index, which maps each vertex to its column of activation_data in the
+    main bundle. hemi_meshes is [(vertices, faces, source_positions)] for lh then rh.
+    Returns a summary of each level for the main bundle's meta.
+    """
+    levels = []
+    for level, cell_size in enumerate(BRAIN_LOD_CELL_SIZES if cell_sizes is None else cell_sizes):
+        parts = {'vertices': [], 'faces': [], 'source_index': []}
+        hemispheres = {}
+        n_vertices = n_faces = n_sources = 0
+        for hemi, (vertices, faces, source_positions) in zip(('lh', 'rh'), hemi_meshes):
+            lod_vertices, lod_faces = decimate_mesh(vertices, faces, cell_size)
+            parts['vertices'].append(lod_vertices)
+            parts['faces'].append(lod_faces + n_vertices)
+            parts['source_index'].append(nearest_source_index(lod_vertices, source_positions, n_sources))
+            hemispheres[hemi] = {
+                'vertices': [n_vertices, n_vertices + len(lod_vertices)],
+                'faces': [n_faces, n_faces + len(lod_faces)]
+            }
+            n_vertices += len(lod_vertices)
+            n_faces += len(lod_faces)
+            n_sources += len(source_positions)
+
+        path = lod_bundle_path(bundle_path, level)
+        brain_bundle.write_bundle(path, {
+            'vertices': np.concatenate(parts['vertices']).astype(np.float32),
+            'faces': np.concatenate(parts['faces']).astype(np.int32),
+            'source_index': np.concatenate(parts['source_index'])
+        }, meta={'level': level, 'cell_size': cell_size, 'hemispheres': hemispheres})
+        write_precompressed(path)
+        levels.append({'level': level, 'cell_size': cell_size, 'n_vertices': n_vertices, 'n_faces': n_faces})
+        print(f"Level {level} mesh ({n_vertices} vertices) exported to: {path}")
+    return levels
+
 # Export brain data for web rendering
-def export_brain_data_for_web(stc, src, output_path='brain_data.json', web_output_dir='brain_web_export'):
-    """Export brain data for web rendering using PyVista's VTK format and JSON."""
-    import pyvista as pv
+def export_brain_data_for_web(stc, src, output_path='brain_data.json', web_output_dir='brain_web_export', export_vtk=True, export_json=True):
+    """
+    Export brain data for web rendering as a binary bundle (see utils/brain_bundle.py)
+    written next to output_path with a .bin extension, plus optionally the legacy JSON
+    at output_path and PyVista's VTK formats. Decimated meshes for each entry of
+    BRAIN_LOD_CELL_SIZES are written alongside (see export_mesh_lods). Each data file gets
+    pre-compressed .br/.gz siblings. Returns (bundle_path, vtk_path).
+    """
     import os
     
     # Create output directory if it doesn't exist
@@ -85,63 +244,152 @@ def export_brain_data_for_web(stc, src, output_path='brain_data.json', web_outpu
     
     # Create a time-info dictionary for the UI
     time_info = {
-        'times': times.tolist(),
         'min_time': float(times.min()),
         'max_time': float(times.max()),
         'time_step': float(times[1] - times[0]) if len(times) > 1 else 0.01
     }
     
-    # Create PyVista mesh for each time point (or just for the initial time)
-    mesh = pv.PolyData(vertices, np.hstack([np.full((faces.shape[0], 1), 3), faces]))
-    mesh.point_data["activation"] = activation_data[0]  # Initial timepoint activation
-    
-    # Export mesh as VTK for web viewing
-    vtk_path = os.path.join(web_output_dir, 'brain_model.vtk')
-    mesh.save(vtk_path)
-    
-    # Also export as vtkjs as an alternative format
-    vtkjs_path = os.path.join(web_output_dir, 'brain_model.vtkjs')
-    mesh.save(vtkjs_path)
+    vtk_path = None
+    if export_vtk:
+        import pyvista as pv
+
+        # Create PyVista mesh for each time point (or just for the initial time)
+        mesh = pv.PolyData(vertices, np.hstack([np.full((faces.shape[0], 1), 3), faces]))
+        mesh.point_data["activation"] = activation_data[0]  # Initial timepoint activation
+
+        # Export mesh as VTK for web viewing
+        vtk_path = os.path.join(web_output_dir, 'brain_model.vtk')
+        mesh.save(vtk_path)
+
+        # Also export as vtkjs as an alternative format
+        vtkjs_path = os.path.join(web_output_dir, 'brain_model.vtkjs')
+        mesh.save(vtkjs_path)
+        print(f"Brain visualization exported to VTK: {vtk_path}")
+        print(f"Brain visualization exported to vtkjs: {vtkjs_path}")
     
-    # Also save the JSON data for time series control
-    data_dict = {
-        'time_info': time_info,
-        'activation_data': activation_data.tolist(),
-        'vertices': vertices.tolist(),
-        'faces': faces.tolist()
+    # Typed arrays with a small JSON header; no per-value Python objects are created.
+    # Activations are stored time-major so a time window is one contiguous byte range.
+    n_lh_sources = len(stc.vertices[0])
+    hemispheres = {
+        'lh': {'vertices': [0, len(lh_vertices)], 'faces': [0, len(lh_faces)], 'sources': [0, n_lh_sources]},
+        'rh': {
+            'vertices': [len(lh_vertices), len(vertices)],
+            'faces': [len(lh_faces), len(faces)],
+            'sources': [n_lh_sources, activation_data.shape[0]]
+        }
     }
+    bundle_path = os.path.splitext(output_path)[0] + '.bin'
+
+    # Decimated meshes for progressive loading; the full mesh stays in the main bundle
+    lh_sources = lh_vertices[stc.vertices[0]]
+    rh_sources = rh_vertices[stc.vertices[1]]
+    lod_levels = export_mesh_lods([(lh_vertices, lh_faces, lh_sources), (rh_vertices, rh_faces, rh_sources)], bundle_path)
+    source_index = np.concatenate([
+        nearest_source_index(lh_vertices, lh_sources),
+        nearest_source_index(rh_vertices, rh_sources, n_lh_sources)
+    ])
+
+    brain_bundle.write_bundle(bundle_path, {
+        'vertices': vertices.astype(np.float32),
+        'faces': faces.astype(np.int32),
+        'source_index': source_index,
+        'times': times.astype(np.float32),
+        'activation_data': activation_data.T.astype(np.float32)
+    }, meta={'time_info': time_info, 'hemispheres': hemispheres, 'activation_layout': 'time_major', 'lod_levels': lod_levels})
+    # Compress once here so the API can serve .br/.gz bytes without per-request work
+    write_precompressed(bundle_path)
+    print(f"Brain data bundle exported to: {bundle_path}")
+
+    if export_json:
+        # Also save the JSON data for time series control
+        data_dict = {
+            'time_info': dict(time_info, times=times.tolist()),
+            'activation_data': activation_data.tolist(),
+            'vertices': vertices.tolist(),
+            'faces': faces.tolist()
+        }
+
+        # Save to JSON
+        with open(output_path, 'w') as f:
+            json.dump(data_dict, f)
+        write_precompressed(output_path)
+
+        print(f"Time info and activation data exported to: {output_path}")
     
-    # Save to JSON
-    with open(output_path, 'w') as f:
-        json.dump(data_dict, f)
-    
-    print(f"Brain visualization exported to VTK: {vtk_path}")
-    print(f"Brain visualization exported to vtkjs: {vtkjs_path}")
-    print(f"Time info and activation data exported to: {output_path}")
-    
-    return output_path, vtk_path
-
-# Export the brain data for web rendering
-# Use absolute path to ensure file is created in the correct location
-current_dir = op.dirname(op.abspath(__file__))
-output_path = op.join(current_dir, 'brain_data.json')
-web_data_path = export_brain_data_for_web(stc, src, output_path)
-
-# Visualize with PyVistaQt backend
-brain = stc.plot(
-    subjects_dir=subjects_dir,
-    surface='white',
-    hemi='split',
-    views=['lat', 'med'],
-    initial_time=0.1,
-    title='EEG Source Estimates (dSPM)'
-)
+    return bundle_path, vtk_path
+
+def patient_output_dir(patient_id):
+    """Directory holding a patient's visualization artifacts."""
+    return op.join(BRAIN_OUTPUT_DIR, validate_patient_id(patient_id))
+
+def generate_patient_brain_data(recording_file, patient_id, progress=None):
+    """
+    Headless source-estimate generation for one patient's recording.
+
+    Runs dSPM on the first BRAIN_SEGMENT_SECONDS of the recording, using the cached
+    inverse operator for its montage, and writes the patient's brain_data.bin bundle.
+    progress, if given, is called with each name in BRAIN_STAGES as that stage starts.
+    Returns the path of the exported data.
+    """
+    report = progress or (lambda stage: None)
+
+    report('loading')
+    raw = mne.io.read_raw_fif(recording_file, preload=False)
+    raw.crop(tmax=min(BRAIN_SEGMENT_SECONDS, raw.times[-1])).load_data()
+    raw.pick('eeg', exclude='bads')
+
+    # Recordings without digitized electrodes get standard 10-20 positions
+    if not any(ch['loc'][:3].any() for ch in raw.info['chs']):
+        raw.set_montage('standard_1020', on_missing='ignore')
+        raw.pick([ch['ch_name'] for ch in raw.info['chs'] if ch['loc'][:3].any()])
+
+    # Inverse modelling of EEG requires an average reference projection
+    raw.set_eeg_reference('average', projection=True)
+    raw.filter(1, 40)
+    if raw.info['sfreq'] > BRAIN_SFREQ:
+        raw.resample(BRAIN_SFREQ)
+
+    report('inverse')
+    inverse_operator = get_inverse_operator(raw.info)
+    stc = apply_inverse_raw(raw, inverse_operator, lambda2=1.0/9.0, method='dSPM')
+
+    report('export')
+    output_dir = patient_output_dir(patient_id)
+    os.makedirs(output_dir, exist_ok=True)
+    bundle_path, _ = export_brain_data_for_web(
+        stc, get_source_space(), op.join(output_dir, 'brain_data.json'), output_dir,
+        export_vtk=False, export_json=False
+    )
+    return bundle_path
+
+if __name__ == '__main__':
+    # Imported here so the module can be used headless by the API
+    import pyvistaqt
+
+    stc, src = prepare_source_data()
+    _, subjects_dir = get_fsaverage()
+
+    # Export the brain data for web rendering
+    # Use absolute path to ensure file is created in the correct location
+    current_dir = op.dirname(op.abspath(__file__))
+    output_path = op.join(current_dir, 'brain_data.json')
+    web_data_path = export_brain_data_for_web(stc, src, output_path)
+
+    # Visualize with PyVistaQt backend
+    brain = stc.plot(
+        subjects_dir=subjects_dir,
+        surface='white',
+        hemi='split',
+        views=['lat', 'med'],
+        initial_time=0.1,
+        title='EEG Source Estimates (dSPM)'
+    )
 
-# Save snapshot
-brain.save_image('eeg_3d_visualization.png')
+    # Save snapshot
+    brain.save_image('eeg_3d_visualization.png')
 
-# Get the plotter instance and start Qt event loop
-print("Close the visualization window to exit the program")
-plotter = brain._renderer.plotter
-plotter.show()  # Remove the interactive=True parameter
-plotter.app.exec_()  # Start Qt event loop
+    # Get the plotter instance and start Qt event loop
+    print("Close the visualization window to exit the program")
+    plotter = brain._renderer.plotter
+    plotter.show()  # Remove the interactive=True parameter
+    plotter.app.exec_()  # Start Qt event loop
@@ -0,0 +1,159 @@
+import io
+import json
+import struct
+import numpy as np
+
+# Binary layout of a brain bundle (all integers little-endian):
+#
+#   magic         4 bytes   b"AIRB"
+#   version       uint32
+#   header_length uint32    length of the JSON header in bytes, a multiple of 4
+#   header        JSON      utf-8, space padded; {"meta": {...}, "arrays": {name: spec}}
+#   data          arrays    raw little-endian array bytes, each starting on a 4-byte boundary
+#
+# Each array spec is {"dtype": "float32" | "int32" | ..., "shape": [...], "offset": n, "length": n}
+# with offset counted from the start of the data section. Arrays are C-ordered, so a
+# browser can wrap each one as a typed array view without parsing anything.
+#
+# Brain exports hold vertices (n_vertices, 3) float32, faces (n_faces, 3) int32,
+# times (n_times,) float32 and activation_data (n_times, n_sources) float32, stored
+# time-major so any time window is a single contiguous byte range. source_index
+# (n_vertices,) int32 maps each mesh vertex to its activation_data column.
+# meta["hemispheres"] gives the [start, stop) vertex, face and source ranges of "lh"
+# and "rh", and meta["lod_levels"] lists the decimated meshes stored beside the bundle
+# as <name>.lod<level>.bin, each holding vertices, faces and source_index.
+#
+# Quantized activations (see quantize_activations) replace activation_data with
+# uint8/uint16 codes plus per-frame activation_scale and activation_offset float32
+# arrays of shape (n_times,), described by meta["activation_encoding"] =
+# {"bits": 8 | 16, "delta": bool}. To decode, if delta is set take the running sum of
+# the codes along time modulo 2**bits, then value[t, s] = offset[t] + scale[t] * code[t, s].
+MAGIC = b"AIRB"
+VERSION = 1
+MEDIA_TYPE = "application/octet-stream"
+_PREAMBLE = struct.Struct("<4sII")
+QUANTIZED_DTYPES = {8: np.uint8, 16: np.uint16}
+
+
+def _align(n, alignment=4):
+    return (n + alignment - 1) // alignment * alignment
+
+
+def write_bundle(path, arrays, meta=None):
+    """
+    Write named NumPy arrays plus a JSON-serializable meta dict as a brain bundle.
+    path may be a file path or a writable, seekable binary file object.
+    """
+    specs = {}
+    offset = 0
+    prepared = []
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        array = array.astype(array.dtype.newbyteorder("<"), copy=False)
+        specs[name] = {
+            "dtype": array.dtype.name,
+            "shape": list(array.shape),
+            "offset": offset,
+            "length": array.nbytes,
+        }
+        prepared.append((offset, array))
+        offset = _align(offset + array.nbytes)
+
+    header = json.dumps({"meta": meta or {}, "arrays": specs}).encode("utf-8")
+    header += b" " * (_align(len(header)) - len(header))
+
+    def write(f):
+        f.write(_PREAMBLE.pack(MAGIC, VERSION, len(header)))
+        f.write(header)
+        data_start = f.tell()
+        for array_offset, array in prepared:
+            f.seek(data_start + array_offset)
+            f.write(memoryview(array).cast("B"))
+        # Pad the final array so the total length matches the offsets in the header
+        f.truncate(data_start + offset)
+
+    if hasattr(path, "write"):
+        write(path)
+    else:
+        with open(path, "wb") as f:
+            write(f)
+    return path
+
+
+def encode_bundle(arrays, meta=None):
+    """Return a brain bundle as bytes, for serving computed selections without touching disk."""
+    buffer = io.BytesIO()
+    write_bundle(buffer, arrays, meta)
+    return buffer.getvalue()
+
+
+def read_header(path):
+    """Return (header, data_offset) of a bundle without reading any array data."""
+    with open(path, "rb") as f:
+        magic, version, header_length = _PREAMBLE.unpack(f.read(_PREAMBLE.size))
+        if magic != MAGIC:
+            raise ValueError(f"Not a brain bundle: {path}")
+        if version != VERSION:
+            raise ValueError(f"Unsupported brain bundle version {version}")
+        header = json.loads(f.read(header_length))
+    return header, _PREAMBLE.size + header_length
+
+
+def load_arrays(path, mmap=True):
+    """
+    Return (meta, arrays) for a bundle. With mmap, arrays are read-only memory maps,
+    so only the bytes that are actually touched get read from disk.
+    """
+    header, data_offset = read_header(path)
+    arrays = {}
+    for name, spec in header["arrays"].items():
+        dtype = np.dtype(spec["dtype"]).newbyteorder("<")
+        shape = tuple(spec["shape"])
+        if mmap and spec["length"] > 0:
+            arrays[name] = np.memmap(path, dtype=dtype, mode="r", offset=data_offset + spec["offset"], shape=shape)
+        else:
+            count = int(np.prod(shape))
+            arrays[name] = np.fromfile(path, dtype=dtype, count=count, offset=data_offset + spec["offset"]).reshape(shape)
+    return header["meta"], arrays
+
+
+def quantize_activations(activation_data, bits=8, delta=True):
+    """
+    Quantize time-major activations (n_times, n_sources) to bits-wide codes with a
+    per-frame scale and offset. With delta, each frame after the first stores its
+    difference from the previous frame modulo 2**bits, which compresses much better.
+    Returns (arrays, encoding) in the layout described at the top of this module.
+    """
+    if bits not in QUANTIZED_DTYPES:
+        raise ValueError(f"Activations can be quantized to {sorted(QUANTIZED_DTYPES)} bits, not {bits}")
+    data = np.asarray(activation_data, dtype=np.float32)
+    dtype = QUANTIZED_DTYPES[bits]
+
+    if data.shape[1]:
+        offset = data.min(axis=1)
+        scale = (data.max(axis=1) - offset) / ((1 << bits) - 1)
+    else:
+        offset = scale = np.zeros(len(data), dtype=np.float32)
+    # Constant frames decode to their offset whatever the scale
+    scale = np.where(scale > 0, scale, 1).astype(np.float32)
+
+    codes = np.rint((data - offset[:, None]) / scale[:, None]).astype(dtype)
+    if delta and len(codes) > 1:
+        # Unsigned subtraction wraps, which is what makes the running-sum decode exact
+        codes[1:] = np.diff(codes, axis=0)
+
+    arrays = {
+        "activation_data": codes,
+        "activation_scale": scale,
+        "activation_offset": offset.astype(np.float32),
+    }
+    return arrays, {"bits": bits, "delta": bool(delta)}
+
+
+def dequantize_activations(arrays, encoding):
+    """Inverse of quantize_activations: float32 (n_times, n_sources) activations."""
+    codes = np.asarray(arrays["activation_data"])
+    if encoding.get("delta"):
+        codes = np.cumsum(codes, axis=0, dtype=codes.dtype)
+    return (codes.astype(np.float32) * arrays["activation_scale"][:, None]
+            + arrays["activation_offset"][:, None])
@@ -0,0 +1,106 @@
+import os
+import re
+
+# Approximate prompt budget (tokens) for one chat request, excluding the answer
+CHAT_CONTEXT_TOKENS = int(os.getenv("CHAT_CONTEXT_TOKENS", "6000"))
+# Most recent conversation messages always sent verbatim
+CHAT_RECENT_MESSAGES = int(os.getenv("CHAT_RECENT_MESSAGES", "6"))
+# Cap on the EEG analysis context included in the system prompt
+CHAT_EEG_CONTEXT_TOKENS = int(os.getenv("CHAT_EEG_CONTEXT_TOKENS", "1500"))
+# Length of each older message's entry in the summary of earlier turns
+SUMMARY_ENTRY_CHARS = 200
+
+# Roughly four characters per token for English text, plus a few per message for role framing
+CHARS_PER_TOKEN = 4
+MESSAGE_OVERHEAD_TOKENS = 4
+
+EEG_CONTEXT_PLACEHOLDER = "[EEG analysis context, given above]"
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s")
+
+
+def estimate_tokens(text):
+    """Cheap token estimate; good enough for budgeting without a tokenizer."""
+    return (len(text or "") + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def message_tokens(message):
+    return estimate_tokens(message.get("content", "")) + MESSAGE_OVERHEAD_TOKENS
+
+
+def truncate_to_tokens(text, max_tokens):
+    """Trim text to about max_tokens, marking the cut."""
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    return text[:max(0, max_chars - 16)].rstrip() + " ...[truncated]"
+
+
+def strip_eeg_context(message, eeg_context):
+    """Replace repeats of the EEG context inside a message, which is already sent once in the system prompt."""
+    content = message.get("content", "")
+    if eeg_context and eeg_context in content:
+        content = content.replace(eeg_context, EEG_CONTEXT_PLACEHOLDER)
+    return {"role": message.get("role", "user"), "content": content}
+
+
+def summarize_messages(messages, max_tokens):
+    """
+    Extractive summary of older turns: the first sentence of each message, newest kept
+    when the summary has to be cut to max_tokens. Returns None if nothing fits.
+    """
+    entries = []
+    for message in messages:
+        text = " ".join(message["content"].split())
+        first = _SENTENCE_END.split(text, maxsplit=1)[0][:SUMMARY_ENTRY_CHARS]
+        if first:
+            entries.append(f"- {message['role']}: {first}")
+
+    header = "Summary of the earlier conversation:"
+    budget = max_tokens - MESSAGE_OVERHEAD_TOKENS - estimate_tokens(header)
+    kept = []
+    for entry in reversed(entries):
+        cost = estimate_tokens(entry) + 1
+        if cost > budget:
+            break
+        kept.append(entry)
+        budget -= cost
+    if not kept:
+        return None
+    return {"role": "system", "content": "\n".join([header] + kept[::-1])}
+
+
+def compact_messages(system_prompt, eeg_context, conversation, new_message, budget=None):
+    """
+    Build the message list for one chat request within an approximate token budget.
+
+    The EEG context is capped and sent once, in the system prompt; copies of it in
+    earlier turns are replaced by a placeholder. The last CHAT_RECENT_MESSAGES turns are
+    kept verbatim while they fit, older turns are folded into a short summary and
+    whatever still does not fit is dropped, oldest first.
+    """
+    budget = CHAT_CONTEXT_TOKENS if budget is None else budget
+    eeg_context = (eeg_context or "").strip()
+    capped_context = truncate_to_tokens(eeg_context, CHAT_EEG_CONTEXT_TOKENS)
+    system = {"role": "system", "content": system_prompt.format(context=capped_context)}
+    latest = {"role": "user", "content": new_message}
+
+    # Client-sent system messages would duplicate the prompt built here
+    history = [
+        strip_eeg_context(message, eeg_context)
+        for message in conversation
+        if message.get("role") != "system" and message.get("content")
+    ]
+
+    remaining = budget - message_tokens(system) - message_tokens(latest)
+    recent = []
+    for message in reversed(history[-CHAT_RECENT_MESSAGES:] if CHAT_RECENT_MESSAGES else []):
+        cost = message_tokens(message)
+        if cost > remaining:
+            break
+        recent.append(message)
+        remaining -= cost
+    recent.reverse()
+
+    older = history[:len(history) - len(recent)]
+    summary = summarize_messages(older, remaining) if older else None
+    return [system] + ([summary] if summary else []) + recent + [latest]
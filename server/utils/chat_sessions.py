@@ -0,0 +1,195 @@
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from utils.files import write_json_atomic
+
+try:
+    import fcntl
+except ImportError:  # Windows: appends are only serialized within one process
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Sessions idle longer than this are forgotten
+CHAT_SESSION_TTL = float(os.getenv("CHAT_SESSION_TTL", str(4 * 3600)))
+CHAT_SESSION_MAX = int(os.getenv("CHAT_SESSION_MAX", "1000"))
+# Optional directory to persist sessions in, so they survive restarts and are shared between workers
+CHAT_SESSION_DIR = os.getenv("CHAT_SESSION_DIR")
+# Seconds between background sweeps for expired sessions
+CHAT_SESSION_PURGE_INTERVAL = float(os.getenv("CHAT_SESSION_PURGE_INTERVAL", "600"))
+# Lock file in the session directory guarding read-modify-write across processes
+LOCK_FILE = ".lock"
+
+
+class ChatSessionStore:
+    """
+    Server-side chat sessions: the EEG analysis context and the conversation so far,
+    so clients only send each new message.
+
+    Sessions live in an in-memory LRU bounded by max_sessions and expire ttl seconds
+    after their last use. When directory is set each session is also written to a JSON
+    file there, and that file is the source of truth: a cached copy is only used while
+    the file is unchanged, and appends re-read and rewrite it under a lock shared by all
+    processes using the directory.
+
+    All methods do blocking file I/O; call them from a thread pool in async code.
+    """
+    def __init__(self, max_sessions=1000, ttl=4 * 3600, directory=None):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.directory = directory
+        # session id -> (session, file signature it was read from or written as)
+        self._sessions = OrderedDict()
+        self._lock = threading.RLock()
+        self._lock_depth = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, session_id):
+        return os.path.join(self.directory, f"{session_id}.json")
+
+    def _expired(self, session):
+        return time.time() - session["updated_at"] > self.ttl
+
+    @staticmethod
+    def _signature(path):
+        # Every write replaces the file, so the inode changes even when mtime granularity is coarse
+        stat = os.stat(path)
+        return stat.st_ino, stat.st_mtime_ns
+
+    @contextmanager
+    def _locked(self):
+        """Serialize read-modify-write within this process and, with a directory, across processes."""
+        with self._lock:
+            # Re-entrant: a nested flock on a second descriptor would wait on ourselves
+            if not self.directory or fcntl is None or self._lock_depth:
+                self._lock_depth += 1
+                try:
+                    yield
+                finally:
+                    self._lock_depth -= 1
+                return
+            with open(os.path.join(self.directory, LOCK_FILE), 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                self._lock_depth += 1
+                try:
+                    yield
+                finally:
+                    self._lock_depth -= 1
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def create(self, alpha_context=""):
+        now = time.time()
+        session = {
+            "id": uuid.uuid4().hex,
+            "alpha_context": alpha_context or "",
+            "conversation": [],
+            "created_at": now,
+            "updated_at": now
+        }
+        self._save(session)
+        return session
+
+    def get(self, session_id):
+        """Return a copy of the session, or None if it is unknown or has expired."""
+        if not session_id or not all(c in "0123456789abcdef" for c in session_id):
+            return None
+        session = self._load(session_id)
+        if session is None:
+            return None
+        if self._expired(session):
+            self.delete(session_id)
+            return None
+        return dict(session, conversation=list(session["conversation"]))
+
+    def append(self, session_id, messages, alpha_context=None):
+        """Add messages to a session's conversation, optionally replacing its EEG context."""
+        with self._locked():
+            # Re-read under the lock so turns saved by other workers are kept
+            session = self.get(session_id)
+            if session is None:
+                return None
+            session["conversation"].extend(messages)
+            if alpha_context is not None:
+                session["alpha_context"] = alpha_context
+            session["updated_at"] = time.time()
+            self._save(session)
+        return session
+
+    def delete(self, session_id):
+        with self._locked():
+            with self._lock:
+                self._sessions.pop(session_id, None)
+            if self.directory:
+                try:
+                    os.remove(self._path(session_id))
+                except OSError:
+                    pass
+
+    def _load(self, session_id):
+        with self._lock:
+            cached = self._sessions.get(session_id)
+            if cached is not None:
+                self._sessions.move_to_end(session_id)
+        if not self.directory:
+            return cached[0] if cached else None
+
+        path = self._path(session_id)
+        try:
+            signature = self._signature(path)
+            if cached is not None and cached[1] == signature:
+                return cached[0]
+            with open(path, 'r') as f:
+                session = json.load(f)
+        except (OSError, ValueError):
+            # Deleted or expired by another worker
+            with self._lock:
+                self._sessions.pop(session_id, None)
+            return None
+        self._remember(session, signature)
+        return session
+
+    def _remember(self, session, signature=None):
+        with self._lock:
+            self._sessions[session["id"]] = (session, signature)
+            self._sessions.move_to_end(session["id"])
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def _save(self, session):
+        if not self.directory:
+            self._remember(session)
+            return
+        path = self._path(session["id"])
+        try:
+            write_json_atomic(path, session)
+            self._remember(session, self._signature(path))
+        except OSError as e:
+            logger.error(f"Failed to persist chat session {session['id']}: {e}")
+            # A cached copy with no signature is re-read from disk on next use
+            self._remember(session)
+
+    def purge_expired(self):
+        """Forget expired sessions in memory and on disk. Meant to run periodically, off the request path."""
+        with self._lock:
+            expired = [sid for sid, (session, _) in self._sessions.items() if self._expired(session)]
+            for session_id in expired:
+                del self._sessions[session_id]
+        if not self.directory:
+            return
+        cutoff = time.time() - self.ttl
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                # updated_at and the file's mtime move together, so the stat is enough
+                if os.stat(path).st_mtime < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
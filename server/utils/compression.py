@@ -0,0 +1,127 @@
+import os
+import gzip
+from utils.files import write_atomic
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Responses smaller than this are not worth compressing on the fly
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+# On-the-fly gzip favours speed; pre-compressed artifacts are written once, so they use the best ratio
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))
+PRECOMPRESS_GZIP_LEVEL = 9
+PRECOMPRESS_BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "11"))
+
+# File suffix of each pre-compressed artifact, in order of preference
+SUFFIXES = {"br": ".br", "gzip": ".gz"}
+
+
+def available_encodings():
+    """Content codings this server can produce, best first. Brotli needs the optional brotli package."""
+    return [encoding for encoding in SUFFIXES if encoding != "br" or brotli is not None]
+
+
+def compress(data, encoding):
+    """Compress bytes with the given content coding ('br' or 'gzip')."""
+    if encoding == "br":
+        if brotli is None:
+            raise ValueError("Brotli compression requires the brotli package")
+        return brotli.compress(data, quality=PRECOMPRESS_BROTLI_QUALITY)
+    if encoding == "gzip":
+        # mtime=0 keeps the output identical for identical input
+        return gzip.compress(data, compresslevel=PRECOMPRESS_GZIP_LEVEL, mtime=0)
+    raise ValueError(f"Unsupported content encoding: {encoding}")
+
+
+def negotiate_encoding(accept_encoding, encodings=None):
+    """
+    Pick the content coding to use for a request's Accept-Encoding header, or None
+    for identity. Higher q-values win; ties go to the order of encodings.
+    """
+    encodings = available_encodings() if encodings is None else encodings
+    if not accept_encoding:
+        return None
+
+    weights = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        name = name.strip().lower()
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if name == "x-gzip":
+            name = "gzip"
+        weights[name] = quality
+
+    best, best_quality = None, 0.0
+    for encoding in encodings:
+        quality = weights.get(encoding, weights.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def precompressed_path(path, encoding):
+    """Path of path's pre-compressed artifact for encoding, or None if it is missing or stale."""
+    compressed = path + SUFFIXES[encoding]
+    try:
+        if os.stat(compressed).st_mtime_ns >= os.stat(path).st_mtime_ns:
+            return compressed
+    except OSError:
+        pass
+    return None
+
+
+def write_precompressed(path, encodings=None):
+    """
+    Write a compressed copy of path next to it for each available encoding
+    (path.br, path.gz), so servers can send the bytes without compressing per request.
+    Returns the written paths.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+
+    written = []
+    for encoding in encodings or available_encodings():
+        target = path + SUFFIXES[encoding]
+        # Written atomically so a request never reads a partial artifact
+        write_atomic(target, compress(data, encoding))
+        written.append(target)
+    return written
+
+
+# Streaming media types that must never be buffered by response compression
+UNCOMPRESSED_STREAM_TYPES = (b"text/event-stream",)
+
+
+class StreamingPassthroughMiddleware:
+    """
+    ASGI middleware for use inside a compression middleware: streaming responses
+    (UNCOMPRESSED_STREAM_TYPES) without a Content-Encoding get "identity", so an outer
+    GZipMiddleware passes them through instead of holding chunks in its gzip buffer
+    (starlette before 0.46 compresses event streams too).
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_passthrough(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                names = {name.lower() for name, _ in headers}
+                content_type = next((value for name, value in headers if name.lower() == b"content-type"), b"")
+                if b"content-encoding" not in names and content_type.lower().startswith(UNCOMPRESSED_STREAM_TYPES):
+                    message = dict(message, headers=headers + [(b"content-encoding", b"identity")])
+            await send(message)
+
+        await self.app(scope, receive, send_passthrough)
@@ -0,0 +1,127 @@
+import os
+import pickle
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Directory holding <condition>_model.pkl classifiers
+CONDITION_MODEL_DIR = os.getenv(
+    "EEG_CONDITION_MODEL_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "models")
+)
+
+
+def condition_features(predictions):
+    """
+    Feature matrix the condition classifiers score: one row per window or patient holding
+    the network's [eeg_id, lpd, gpd, lrda, grda, other] outputs.
+    """
+    return np.atleast_2d(np.asarray(predictions, dtype=np.float64))
+
+
+class ConditionModels:
+    """
+    Per-condition probability classifiers (scikit-learn style, with predict_proba),
+    unpickled once and kept resident.
+
+    A classifier is used only if its file exists, loads and expects as many features as
+    condition_features produces; any other condition is scored by the fallback.
+    """
+    def __init__(self, conditions, n_features, directory=CONDITION_MODEL_DIR):
+        self.conditions = list(conditions)
+        self.n_features = n_features
+        self.directory = directory
+        self.models = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, len(self.conditions)), thread_name_prefix="condition")
+
+    def path(self, condition):
+        return os.path.join(self.directory, f"{condition}_model.pkl")
+
+    def load(self):
+        """(Re)load every condition's classifier. Returns the conditions that will use one."""
+        models, errors = {}, {}
+        for condition in self.conditions:
+            path = self.path(condition)
+            if not os.path.exists(path):
+                errors[condition] = "missing"
+                continue
+            try:
+                with open(path, 'rb') as f:
+                    model = pickle.load(f)
+            except Exception as e:
+                logger.error(f"Failed to load {path}: {e}")
+                errors[condition] = str(e)
+                continue
+
+            expected = getattr(model, "n_features_in_", self.n_features)
+            if not hasattr(model, "predict_proba"):
+                errors[condition] = "no predict_proba"
+            elif expected != self.n_features:
+                errors[condition] = f"expects {expected} features, condition features have {self.n_features}"
+            else:
+                models[condition] = model
+                continue
+            logger.warning(f"Not using {path} ({errors[condition]}); {condition} falls back to the heuristic")
+
+        with self._lock:
+            self.models, self.errors = models, errors
+        logger.info(f"Condition classifiers loaded for: {sorted(models) or 'none'}")
+        return sorted(models)
+
+    def score(self, predictions, fallback):
+        """
+        Score every row of predictions for every condition in one batched call per
+        classifier, the classifiers running concurrently. Conditions without one are
+        taken from fallback(predictions), an (N, len(conditions)) array.
+        Returns an (N, len(conditions)) array of probabilities.
+        """
+        features = condition_features(predictions)
+        with self._lock:
+            models = dict(self.models)
+
+        futures = {
+            condition: self._executor.submit(self._predict, model, features)
+            for condition, model in models.items()
+        }
+        if len(models) < len(self.conditions):
+            scores = np.array(fallback(predictions), dtype=np.float64)
+        else:
+            scores = np.empty((len(features), len(self.conditions)))
+
+        for condition, future in futures.items():
+            column = self.conditions.index(condition)
+            try:
+                scores[:, column] = future.result()
+            except Exception as e:
+                logger.error(f"{condition} classifier failed, using the heuristic: {e}")
+                scores[:, column] = np.asarray(fallback(predictions))[:, column]
+        return scores
+
+    @staticmethod
+    def _predict(model, features):
+        names = getattr(model, "feature_names_in_", None)
+        # Classifiers fitted on DataFrames expect their column names back
+        data = pd.DataFrame(features, columns=names) if names is not None else features
+        return model.predict_proba(data)[:, 1]
+
+    def version(self):
+        """Identifier of the classifiers in use, for result cache keys."""
+        with self._lock:
+            models = sorted(self.models)
+        if not models:
+            return "heuristic"
+        return ",".join(f"{condition}@{os.path.getmtime(self.path(condition))}" for condition in models)
+
+    def info(self):
+        with self._lock:
+            return {
+                "directory": self.directory,
+                "loaded": sorted(self.models),
+                "fallback": {condition: error for condition, error in self.errors.items()},
+            }
@@ -0,0 +1,27 @@
+import os
+import json
+import tempfile
+
+
+def write_atomic(path, data):
+    """
+    Write bytes or text to path through a temp file in the same directory and a rename,
+    so concurrent readers see either the old file or the complete new one, never a partial write.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb" if isinstance(data, bytes) else "w") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def write_json_atomic(path, value):
+    """Atomically write a JSON-serializable value to path (see write_atomic)."""
+    write_atomic(path, json.dumps(value))
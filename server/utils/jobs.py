@@ -0,0 +1,153 @@
+import time
+import uuid
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import CancelledError, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+logger = logging.getLogger(__name__)
+
+# Reported for jobs whose worker process died, e.g. killed for running out of memory
+WORKER_DIED_ERROR = "Worker process terminated abruptly (possibly out of memory); the job did not finish"
+
+
+def _run_job(fn, job_id, progress, args, kwargs):
+    """Worker-side wrapper: records stage changes in the shared progress dict, then runs fn."""
+    def report(stage):
+        progress[job_id] = {"stage": stage, "updated_at": time.time()}
+
+    report("running")
+    return fn(*args, progress=report, **kwargs)
+
+
+class JobManager:
+    """
+    Runs long EEG jobs on a bounded process pool and tracks their status.
+
+    Jobs are submitted with submit() and return an id immediately. Job
+    functions receive a progress callable and report each stage as it starts;
+    get() returns the current status, stage and, once finished, the result.
+    MNE and torch work is CPU-bound, so jobs run in separate processes rather
+    than threads. Finished jobs are kept for job_ttl seconds.
+
+    If a worker process dies the pool is broken for good: every job still on it
+    fails with WORKER_DIED_ERROR and the next submit() starts a fresh pool.
+    """
+    def __init__(self, max_workers=2, initializer=None, stages=None, job_ttl=3600):
+        self.max_workers = max_workers
+        self.initializer = initializer
+        self.stages = stages or []
+        self.job_ttl = job_ttl
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._executor = None
+        self._manager = None
+        self._progress = None
+
+    def _ensure_executor(self):
+        # Created lazily so importing the module never forks or spawns anything
+        if self._executor is None:
+            context = multiprocessing.get_context("spawn")
+            self._manager = context.Manager()
+            self._progress = self._manager.dict()
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers, mp_context=context, initializer=self.initializer
+            )
+        return self._executor
+
+    def _discard_executor(self, executor):
+        # Callers hold self._lock; only the pool that broke is dropped, not a replacement
+        if self._executor is executor:
+            self._executor = None
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _purge_expired(self):
+        cutoff = time.time() - self.job_ttl
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job["finished_at"] is not None and job["finished_at"] < cutoff
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+            self._progress.pop(job_id, None)
+
+    def submit(self, fn, *args, on_done=None, **kwargs):
+        """
+        Queue fn(*args, progress=..., **kwargs) on the worker pool and return the job id.
+        on_done(job) runs in this process once the job has finished, successfully or not.
+        """
+        job_id = str(uuid.uuid4())
+        with self._lock:
+            executor = self._ensure_executor()
+            self._purge_expired()
+            self._jobs[job_id] = {
+                "id": job_id,
+                "status": "queued",
+                "stage": "queued",
+                "result": None,
+                "error": None,
+                "created_at": time.time(),
+                "finished_at": None,
+            }
+            try:
+                future = executor.submit(_run_job, fn, job_id, self._progress, args, kwargs)
+            except BrokenProcessPool:
+                # A worker died since the last job finished; replace the pool and retry once
+                logger.warning("Process pool is broken, starting a new one")
+                self._discard_executor(executor)
+                executor = self._ensure_executor()
+                future = executor.submit(_run_job, fn, job_id, self._progress, args, kwargs)
+        future.add_done_callback(lambda f: self._finish(job_id, f, on_done, executor))
+        return job_id
+
+    def _finish(self, job_id, future, on_done, executor):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            try:
+                job["result"] = future.result()
+                job["status"] = "completed"
+                job["stage"] = "done"
+            except (BrokenProcessPool, CancelledError):
+                # Jobs queued behind the dead worker are failed (or cancelled) along with it
+                logger.error(f"Job {job_id} failed: worker process died")
+                job["status"] = "failed"
+                job["error"] = WORKER_DIED_ERROR
+                self._discard_executor(executor)
+            except Exception as e:
+                logger.error(f"Job {job_id} failed: {e}")
+                job["status"] = "failed"
+                job["error"] = str(e)
+            job["finished_at"] = time.time()
+            snapshot = dict(job)
+        if on_done is not None:
+            try:
+                on_done(snapshot)
+            except Exception as e:
+                logger.error(f"on_done callback for job {job_id} failed: {e}")
+
+    def get(self, job_id):
+        """Return a snapshot of the job's status, or None if the id is unknown or expired."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            job = dict(job)
+        if job["status"] == "queued" and self._progress is not None:
+            update = self._progress.get(job_id)
+            if update is not None:
+                job["stage"] = update["stage"]
+                job["status"] = "running"
+        if job["stage"] in self.stages:
+            job["progress"] = self.stages.index(job["stage"]) / len(self.stages)
+        else:
+            job["progress"] = 1.0 if job["status"] == "completed" else 0.0
+        return job
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._manager.shutdown()
+            self._executor = None
@@ -0,0 +1,194 @@
+import os
+import pickle
+import threading
+import logging
+import traceback
+import numpy as np
+import torch
+# Net must be importable for torch.load to unpickle the full model object
+from mdl_4 import Net
+
+logger = logging.getLogger(__name__)
+
+# Returned when no model could be loaded, matching the previous /upload behaviour
+MOCK_PREDICTIONS = np.array([1, 0.3, 0.2, 0.7, 0.4, 0.6])
+
+
+def _load_torch_full(model_path):
+    return torch.load(model_path, map_location='cpu', weights_only=False)
+
+
+def _load_torch_jit(model_path):
+    return torch.jit.load(model_path, map_location='cpu')
+
+
+def _load_pickle(model_path):
+    with open(model_path, 'rb') as f:
+        return pickle.load(f)
+
+
+def _load_torch_safe_globals(model_path):
+    with torch.serialization.safe_globals([Net]):
+        return torch.load(model_path, map_location='cpu')
+
+
+# Loader strategies, tried in order until one succeeds
+LOADERS = [
+    ("torch.load direct", _load_torch_full),
+    ("torch.jit.load", _load_torch_jit),
+    ("direct pickle", _load_pickle),
+    ("safe_globals context", _load_torch_safe_globals),
+]
+
+
+def describe_model(model):
+    """Summarise a loaded model object for logging."""
+    if isinstance(model, dict):
+        return {"type": type(model).__name__, "is_dictionary": True, "keys": list(model.keys())}
+    return {
+        "type": type(model).__name__,
+        "is_dictionary": False,
+        "has_predict": hasattr(model, "predict"),
+        "is_callable": callable(model),
+    }
+
+
+class ModelRegistry:
+    """
+    Keeps the EEG model resident in memory across requests.
+
+    The model is deserialized once, switched to eval mode and reused for every
+    prediction. The loader strategy that succeeded is remembered so reloads go
+    straight to it, and the model is reloaded when the file's mtime changes.
+    """
+    def __init__(self, model_path):
+        self.model_path = model_path
+        self.model = None
+        self.loader = None
+        self.mtime = None
+        self.errors = []
+        self._lock = threading.RLock()
+
+    def _file_mtime(self):
+        try:
+            return os.path.getmtime(self.model_path)
+        except OSError:
+            return None
+
+    def load(self):
+        """Load (or reload) the model from disk. Returns True on success."""
+        with self._lock:
+            mtime = self._file_mtime()
+            if mtime is None:
+                logger.warning(f"Model file not found: {self.model_path}")
+                self.model, self.mtime = None, None
+                return False
+
+            # Try the last successful strategy first
+            loaders = sorted(LOADERS, key=lambda item: item[0] != self.loader)
+            errors = []
+            for name, loader in loaders:
+                try:
+                    logger.info(f"Loading model from {self.model_path} with {name}")
+                    model = loader(self.model_path)
+                    if isinstance(model, dict):
+                        raise TypeError("Model file contains a state dict, not a model object")
+                    if isinstance(model, torch.nn.Module):
+                        model.eval()
+                    self.model, self.loader, self.mtime = model, name, mtime
+                    self.errors = errors
+                    logger.info(f"Model loaded with {name}: {describe_model(model)}")
+                    return True
+                except Exception as e:
+                    error_msg = f"{name} failed: {str(e)}\n{traceback.format_exc()}"
+                    logger.error(error_msg)
+                    errors.append({"method": name, "error": error_msg})
+
+            self.model, self.mtime = None, mtime
+            self.errors = errors
+            return False
+
+    def get(self):
+        """Return the resident model, reloading it if the file changed on disk."""
+        mtime = self._file_mtime()
+        if mtime != self.mtime:
+            with self._lock:
+                if mtime != self.mtime:
+                    logger.info("Model file changed on disk, reloading")
+                    self.load()
+        return self.model
+
+    def predict(self, data, **kwargs):
+        """
+        Run the resident model on EEG data, falling back to mock predictions.
+        Keyword arguments (window, stride, batch_size) are forwarded to Net.predict.
+        """
+        model = self.get()
+        if model is None:
+            logger.warning("No model loaded, using mock predictions")
+            return MOCK_PREDICTIONS.copy()
+
+        with torch.inference_mode():
+            if hasattr(model, 'predict'):
+                return model.predict(data, **kwargs)
+
+            input_tensor = torch.tensor(np.asarray(data), dtype=torch.float32)
+            predictions = model(input_tensor)
+            if isinstance(predictions, torch.Tensor):
+                predictions = predictions.detach().numpy()
+            return predictions
+
+    def predict_windows(self, data, **kwargs):
+        """
+        Per-window inference: the model's dict of 'mean', 'max', 'timeline' and 'starts',
+        or None when no model is loaded, it has no windowed inference or it fails.
+        """
+        model = self.get()
+        if model is None or not hasattr(model, 'predict_windows'):
+            return None
+
+        with torch.inference_mode():
+            try:
+                return model.predict_windows(data, **kwargs)
+            except Exception as e:
+                logger.error(f"Windowed prediction failed: {e}")
+                return None
+
+    def predict_batch(self, recordings, **kwargs):
+        """
+        Run the resident model on several recordings, sharing mini-batches across them.
+        Returns one prediction vector per recording, mock predictions where inference
+        was not possible.
+        """
+        model = self.get()
+        if model is None:
+            logger.warning("No model loaded, using mock predictions")
+            return [MOCK_PREDICTIONS.copy() for _ in recordings]
+
+        if not hasattr(model, 'predict_batch'):
+            return [self.predict(data, **kwargs) for data in recordings]
+
+        with torch.inference_mode():
+            try:
+                results = model.predict_batch(recordings, **kwargs)
+            except Exception as e:
+                logger.error(f"Batched prediction failed: {e}")
+                return [MOCK_PREDICTIONS.copy() for _ in recordings]
+
+        return [MOCK_PREDICTIONS.copy() if result is None else result["mean"] for result in results]
+
+    def version(self):
+        """Identifier of the resident model, changing whenever the model file is reloaded."""
+        if self.model is None:
+            return "mock"
+        return f"{os.path.basename(self.model_path)}@{self.mtime}"
+
+    def info(self):
+        """Status of the resident model for health checks."""
+        return {
+            "model_path": self.model_path,
+            "loaded": self.model is not None,
+            "loader": self.loader,
+            "mtime": self.mtime,
+            "errors": [e["method"] for e in self.errors],
+        }
@@ -0,0 +1,449 @@
+import os
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+import mne
+import numpy as np
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+import torch
+# Import the Net class directly - this is crucial for loading the model
+from mdl_4 import Net
+# Import timm which is required by the model
+import timm
+from utils.analysis_jobs import PIPELINE_STAGES
+from utils.model_registry import ModelRegistry
+from utils.condition_models import CONDITION_MODEL_DIR, ConditionModels
+from utils.recordings import recording_path
+from utils.preprocessing import ICA_FIT_SFREQ, ICA_SKIP_EOG_CORR, eog_ica, inference_spans, preprocess_spans
+from utils.result_cache import ResultCache, hash_file, cache_key
+
+GROQ_API_KEY = os.getenv("GROQ_API_KEY")
+GROQ_API_URL = os.getenv("GROQ_API_URL", "https://api.groq.com/openai/v1/chat/completions")  # Override to point at a local stub
+GROQ_MODEL = "llama-3.3-70b-versatile"  # Add this model
+# Per-call Groq timeouts in seconds (connect, and overall wait for the response)
+GROQ_CONNECT_TIMEOUT = float(os.getenv("GROQ_CONNECT_TIMEOUT", "5"))
+GROQ_TIMEOUT = float(os.getenv("GROQ_TIMEOUT", "60"))
+# Threads available for concurrent Groq calls across all requests
+LLM_WORKERS = int(os.getenv("GROQ_MAX_WORKERS", "8"))
+MODEL_PATH = os.getenv("EEG_MODEL_PATH", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "single_model.pt"))
+# Directory for optional Parquet exports of preprocessed recordings (disabled when unset)
+PARQUET_EXPORT_DIR = os.getenv("EEG_PARQUET_EXPORT_DIR")
+# Sliding-window inference parameters (in samples)
+WINDOW_SIZE = int(os.getenv("EEG_WINDOW_SIZE", "250"))
+WINDOW_STRIDE = int(os.getenv("EEG_WINDOW_STRIDE", "250"))
+INFERENCE_BATCH_SIZE = int(os.getenv("EEG_INFERENCE_BATCH_SIZE", "32"))
+
+# Preprocessing parameters; part of the result cache key, so changing them invalidates cached results
+BANDPASS = (1, 45)
+NOTCH_FREQS = [50, 60]
+ICA_COMPONENTS = 15
+# Content-addressed cache of finished analyses; set EEG_RESULT_CACHE_DIR empty to keep it in memory only
+RESULT_CACHE_DIR = os.getenv("EEG_RESULT_CACHE_DIR", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "cache", "results"))
+RESULT_CACHE_SIZE = int(os.getenv("EEG_RESULT_CACHE_SIZE", "256"))
+RESULT_CACHE_MAX_BYTES = int(os.getenv("EEG_RESULT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+AI_CONTENT_FALLBACK = "Unable to fetch AI content from the model."
+MEDICATION_FALLBACK = "Unable to fetch medication advice from the model."
+
+# Add Net to PyTorch's safe globals
+torch.serialization.add_safe_globals([Net])
+
+logger = logging.getLogger(__name__)
+
+# Pooled HTTP session and worker threads shared by all Groq API calls
+groq_session = requests.Session()
+groq_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=LLM_WORKERS)
+groq_session.mount("https://", groq_adapter)
+groq_session.mount("http://", groq_adapter)
+llm_executor = ThreadPoolExecutor(max_workers=LLM_WORKERS, thread_name_prefix="groq")
+
+result_cache = ResultCache(
+    max_entries=RESULT_CACHE_SIZE, directory=RESULT_CACHE_DIR or None, max_disk_bytes=RESULT_CACHE_MAX_BYTES
+)
+
+# Resident EEG model for this process, created on first use
+_model_registry = None
+
+def get_model_registry():
+    """Return this process's model registry, loading the model on first call."""
+    global _model_registry
+    if _model_registry is None:
+        _model_registry = ModelRegistry(MODEL_PATH)
+        _model_registry.load()
+    return _model_registry
+
+# Per-condition classifiers for this process, loaded on first use
+_condition_models = None
+
+def get_condition_models():
+    """Return this process's condition classifiers, loading them on first call."""
+    global _condition_models
+    if _condition_models is None:
+        # Classifiers score the network's six outputs per row
+        _condition_models = ConditionModels(CONDITIONS, n_features=6, directory=CONDITION_MODEL_DIR)
+        _condition_models.load()
+    return _condition_models
+
+def init_worker():
+    """Process pool initializer: keep the models resident in each worker process."""
+    logging.basicConfig(level=logging.INFO)
+    get_model_registry()
+    get_condition_models()
+
+# Preprocessing function for .fif EEG files
+def preprocess_eeg(file_path, file_hash=None, patient_id=None):
+    """
+    Filter and artifact-clean a .fif recording, reading only the samples that windowed
+    inference uses (see inference_spans). The file is opened lazily and validated from its
+    header, so long recordings never have to fit in memory at full precision.
+    Returns (eeg_data, ch_names, error) with eeg_data a contiguous float32 (channels, samples) array.
+    """
+    # Add validation for missing measurement data in preprocess_eeg
+    try:
+        # Header only; samples are read span by span while filtering
+        raw = mne.io.read_raw_fif(file_path, preload=False)
+        if raw.info['nchan'] == 0 or raw.n_times == 0:
+            raise ValueError("No measurement data found in the EEG file.")
+    except Exception as e:
+        return None, None, f"Failed to load EEG file: {str(e)}"
+    
+    # Detect and remove artifacts
+    # Check for EOG channels before applying ICA
+    ica = None
+    eog_names = [ch for ch in raw.ch_names if 'EOG' in ch]
+    if not eog_names:
+        logger.info("No EOG channels found. Skipping EOG artifact removal.")
+    else:
+        # The fitted ICA is cached per recording, so only the first analysis pays for the fit
+        ica = eog_ica(raw, eog_names, ICA_COMPONENTS, BANDPASS, NOTCH_FREQS, file_hash or hash_file(file_path), patient_id)
+    
+    # Basic preprocessing: bandpass (1-45 Hz) and line-noise notch as one fused filter pass,
+    # with the ICA cleaning applied chunk by chunk
+    spans = inference_spans(raw.n_times, WINDOW_SIZE, WINDOW_STRIDE)
+    eeg_data = preprocess_spans(raw, BANDPASS, NOTCH_FREQS, spans, ica=ica)
+    return eeg_data, raw.ch_names, None
+
+def inference_stride():
+    """Stride to use over preprocess_eeg output: windows are packed back to back when WINDOW_STRIDE > WINDOW_SIZE."""
+    return min(WINDOW_STRIDE, WINDOW_SIZE)
+
+# Condition scores are weighted sums of the [lpd, gpd, lrda, grda, other] votes, each
+# normalised by the total of the votes it draws on
+CONDITIONS = ["epilepsy", "cognitive_stress", "depression"]
+CONDITION_WEIGHTS = np.array([
+    [0.4, 0.4, 0.2, 0.0, 0.0],  # Epilepsy: higher weight to GPD and LPD
+    [0.0, 0.0, 0.6, 0.2, 0.2],  # Cognitive stress: higher weight to LRDA
+    [0.0, 0.0, 0.3, 0.3, 0.4],  # Depression: mix of patterns
+])
+CONDITION_NORMS = np.array([
+    [1, 1, 1, 0, 0],
+    [0, 0, 1, 1, 1],
+    [0, 0, 1, 1, 1],
+])
+
+def heuristic_condition_scores(predictions):
+    """Weighted-vote condition scores, used for any condition without a usable classifier."""
+    votes = np.atleast_2d(np.asarray(predictions, dtype=np.float64))[:, 1:6]
+    scores = (votes @ CONDITION_WEIGHTS.T) / (votes @ CONDITION_NORMS.T + 0.001)
+    # Ensure probabilities are between 0 and 1
+    return np.clip(scores, 0, 1)
+
+def score_conditions(predictions):
+    """
+    Vectorized condition scoring: predictions is an (N, 6) array of
+    [eeg_id, lpd, gpd, lrda, grda, other] rows (per window or per patient), or a
+    single row. Each condition's classifier in models/ scores all rows in one batched
+    call, falling back to heuristic_condition_scores when it is missing.
+    Returns an (N, 3) array of probabilities in CONDITIONS order.
+    """
+    predictions = np.atleast_2d(np.asarray(predictions, dtype=np.float64))
+    if len(predictions) == 0:
+        return np.empty((0, len(CONDITIONS)))
+    return np.clip(get_condition_models().score(predictions, heuristic_condition_scores), 0, 1)
+
+def calculate_condition_scores(predictions, starts=None):
+    """
+    Score an (N, 6) matrix of predictions in one call. Returns the (N, 3) 'probabilities',
+    a per-condition 'summary' (mean, max and fraction of rows above 0.5) and a columnar
+    'timeline' with one entry per row, starting at starts (samples) when given.
+    """
+    probabilities = score_conditions(predictions)
+    summary = {
+        condition: {
+            "mean": float(column.mean()) if len(column) else 0.0,
+            "max": float(column.max()) if len(column) else 0.0,
+            "fraction_above_half": float((column > 0.5).mean()) if len(column) else 0.0
+        }
+        for condition, column in zip(CONDITIONS, probabilities.T)
+    }
+    timeline = {condition: np.round(column, 4).tolist() for condition, column in zip(CONDITIONS, probabilities.T)}
+    if starts is not None:
+        timeline["start_samples"] = np.asarray(starts).astype(int).tolist()
+    return {"probabilities": probabilities, "summary": summary, "timeline": timeline}
+
+# Convert model outputs to condition probabilities
+def calculate_condition_probabilities(predictions):
+    # Assuming predictions has the format: [eeg_id, lpd_vote, gpd_vote, lrda_vote, grda_vote, other_vote]
+    return dict(zip(CONDITIONS, (float(p) for p in score_conditions(predictions)[0])))
+
+# Single Groq chat completion over the shared session; raises on HTTP or payload errors
+def groq_completion(prompt, temperature=0.7):
+    response = groq_session.post(
+        GROQ_API_URL,
+        headers={
+            "Authorization": f"Bearer {GROQ_API_KEY}",
+            "Content-Type": "application/json"
+        },
+        json={
+            "model": GROQ_MODEL,
+            "messages": [
+                {"role": "system", "content": "You are a neurologist assistant."},
+                {"role": "user", "content": prompt}
+            ],
+            "temperature": temperature
+        },
+        timeout=(GROQ_CONNECT_TIMEOUT, GROQ_TIMEOUT)
+    )
+    response.raise_for_status()
+    return response.json()["choices"][0]["message"]["content"].strip()
+
+# Collect a concurrent Groq call's result before the shared deadline, falling back on failure
+def groq_result(future, deadline, label, fallback):
+    try:
+        return future.result(timeout=max(0, deadline - time.monotonic()))
+    except FuturesTimeoutError:
+        future.cancel()
+        logger.error(f"Groq API call for {label} timed out after {GROQ_TIMEOUT}s")
+    except Exception as e:
+        logger.error(f"Groq API call for {label} failed: {e}")
+    return fallback
+
+# Write the preprocessed recording as a (time_points x channels) Parquet artifact
+def export_parquet(eeg_data, ch_names, filename):
+    os.makedirs(PARQUET_EXPORT_DIR, exist_ok=True)
+    parquet_path = os.path.join(PARQUET_EXPORT_DIR, os.path.splitext(os.path.basename(filename))[0] + ".parquet")
+    pd.DataFrame(eeg_data.T, columns=ch_names).to_parquet(parquet_path)
+    return parquet_path
+
+# Build both LLM prompts and run them concurrently; returns (ai_content, medication)
+def generate_reports(predictions, condition_probabilities):
+    # Create the Groq LLM prompt
+    prompt = f"""
+You are a clinical neurologist AI that analyzes EEG output probabilities.
+
+Given:
+- LPD: {predictions[1]}
+- GPD: {predictions[2]}
+- LRDA: {predictions[3]}
+- GRDA: {predictions[4]}
+- Other: {predictions[5]}
+
+You inferred:
+- Epilepsy likelihood: {condition_probabilities['epilepsy']:.2f}
+- Cognitive stress likelihood: {condition_probabilities['cognitive_stress']:.2f}
+- Depression likelihood: {condition_probabilities['depression']:.2f}
+
+Give a short, clinically sound explanation about these results in simple terms. Mention what these probabilities mean and what the person should do next.
+"""
+
+    medication_prompt = f"""
+You are a clinical neurologist AI that provides medical advice.
+
+Given:
+- LPD: {predictions[1]}
+- GPD: {predictions[2]}
+- LRDA: {predictions[3]}
+- GRDA: {predictions[4]}
+- Other: {predictions[5]}
+
+Provide detailed advice on:
+- Possible effects of medications and surgical treatments.
+- Which treatments are good or bad for the user.
+- Other clinical and medical recommendations.
+"""
+
+    # Dispatch both Groq API calls concurrently and wait for both to complete or time out
+    deadline = time.monotonic() + GROQ_TIMEOUT
+    ai_content_future = llm_executor.submit(groq_completion, prompt)
+    medication_future = llm_executor.submit(groq_completion, medication_prompt)
+
+    ai_content = groq_result(ai_content_future, deadline, "AI content", AI_CONTENT_FALLBACK)
+    medication = groq_result(medication_future, deadline, "medication advice", MEDICATION_FALLBACK)
+
+    return ai_content, medication
+
+def prepare_recording(file_path, filename=None, file_hash=None, patient_id=None):
+    """
+    Preprocess a .fif recording into a contiguous float32 (channels, time_points) matrix.
+    file_hash and patient_id key the cached ICA decomposition. Returns (eeg_data, error).
+    """
+    # The channels x samples matrix goes straight to the model as contiguous float32
+    eeg_data, ch_names, error = preprocess_eeg(file_path, file_hash, patient_id)
+    if error:
+        return None, error
+    logger.info(f"EEG data shape: {eeg_data.shape}, channels: {ch_names[:10]}...")  # Show first 10 channels
+
+    # Optional Parquet export of the preprocessed recording (off by default)
+    if PARQUET_EXPORT_DIR:
+        parquet_path = export_parquet(eeg_data, ch_names, filename or file_path)
+        logger.info(f"Exported preprocessed EEG to .parquet: {parquet_path}")
+
+    return eeg_data, None
+
+def summarize_predictions(predictions, condition_probabilities=None):
+    """
+    Returns (condition_probabilities, raw_data_json, percentage_data_json) for a prediction
+    vector. Pass condition_probabilities when they were already scored in a batch.
+    """
+    # Calculate condition probabilities
+    if condition_probabilities is None:
+        condition_probabilities = calculate_condition_probabilities(predictions)
+    # Prepare raw data and percentage data for AI context
+    raw_data_json = {
+        "lpd": float(predictions[1]),
+        "gpd": float(predictions[2]),
+        "lrda": float(predictions[3]),
+        "grda": float(predictions[4]),
+        "other": float(predictions[5])
+    }
+
+    percentage_data_json = {
+        "epilepsy": f"{condition_probabilities['epilepsy'] * 100:.2f}%",
+        "cognitive_stress": f"{condition_probabilities['cognitive_stress'] * 100:.2f}%",
+        "depression": f"{condition_probabilities['depression'] * 100:.2f}%"
+    }
+    return condition_probabilities, raw_data_json, percentage_data_json
+
+def pipeline_params():
+    """Parameters that affect analysis output, for the result cache key."""
+    return {
+        "bandpass": list(BANDPASS),
+        "notch": NOTCH_FREQS,
+        "filter": "fused_fir_reflect_limited",
+        "ica_components": ICA_COMPONENTS,
+        "ica_fit_sfreq": ICA_FIT_SFREQ,
+        "ica_skip_eog_corr": ICA_SKIP_EOG_CORR,
+        "window": WINDOW_SIZE,
+        "stride": WINDOW_STRIDE,
+        "llm_model": GROQ_MODEL,
+        "condition_models": get_condition_models().version(),
+    }
+
+def analyze_recording(file_path, filename=None, progress=None, file_hash=None, patient_id=None):
+    """
+    Run the full EEG analysis pipeline (preprocessing, inference, scoring, LLM reports)
+    on a .fif recording. Returns (result, error) where result is the /upload payload.
+    progress, if given, is called with each name in PIPELINE_STAGES as that stage starts.
+
+    Results are cached on the SHA-256 of the file (file_hash, computed here when not
+    given), the model version and pipeline_params(), so re-uploading the same recording
+    skips the whole pipeline. patient_id, when the upload belongs to a patient, files the
+    fitted ICA under that patient (see prepare_recording).
+    """
+    report = progress or (lambda stage: None)
+
+    file_hash = file_hash or hash_file(file_path)
+    key = cache_key(file_hash, get_model_registry().version(), pipeline_params())
+    cached = result_cache.get(key)
+    if cached is not None:
+        logger.info(f"Result cache hit for {filename or file_path}")
+        return cached["result"], None
+
+    # Process the EEG data
+    report("preprocessing")
+    eeg_data, error = prepare_recording(file_path, filename, file_hash, patient_id)
+    if error:
+        return None, error
+
+    # Run inference with the resident model, keeping per-window outputs when it provides them
+    report("inference")
+    inference_args = dict(window=WINDOW_SIZE, stride=inference_stride(), batch_size=INFERENCE_BATCH_SIZE)
+    windows = get_model_registry().predict_windows(eeg_data, **inference_args)
+    if windows is not None:
+        predictions = windows["mean"]
+    else:
+        predictions = get_model_registry().predict(eeg_data, **inference_args)
+
+    report("scoring")
+    condition_probabilities, raw_data_json, percentage_data_json = summarize_predictions(predictions)
+    condition_timeline = None
+    if windows is not None:
+        # Window k starts at k * WINDOW_STRIDE in the recording, even when windows were packed
+        scores = calculate_condition_scores(windows["timeline"], np.arange(len(windows["timeline"])) * WINDOW_STRIDE)
+        condition_timeline = dict(scores["timeline"], summary=scores["summary"], window=WINDOW_SIZE, stride=WINDOW_STRIDE)
+
+    report("llm")
+    ai_content, medication = generate_reports(predictions, condition_probabilities)
+
+    result = {
+        "raw": raw_data_json,
+        "percentage": percentage_data_json,
+        "ai_content": ai_content,
+        "medication": medication
+    }
+    if condition_timeline is not None:
+        result["condition_timeline"] = condition_timeline
+    # Don't pin LLM failures in the cache; the next upload should retry them
+    if ai_content != AI_CONTENT_FALLBACK and medication != MEDICATION_FALLBACK:
+        result_cache.set(key, {
+            "result": result,
+            "predictions": [float(p) for p in predictions],
+            "condition_probabilities": condition_probabilities
+        })
+
+    return result, None
+
+def analyze_patients(patient_ids, progress=None):
+    """
+    Run the pipeline on each patient's stored recording, sharing inference across patients:
+    every patient's windows are packed into the same mini-batches through the resident model.
+    Returns a dict mapping patient_id to {"result": ..., "error": ...}, where result has the
+    same shape as the /upload payload.
+    """
+    report = progress or (lambda stage: None)
+    results = {}
+
+    report("preprocessing")
+    recordings = {}
+    for patient_id in patient_ids:
+        eeg_data, error = prepare_recording(recording_path(patient_id), patient_id=patient_id)
+        if error:
+            results[patient_id] = {"result": None, "error": error}
+        else:
+            recordings[patient_id] = eeg_data
+
+    report("inference")
+    batch_predictions = get_model_registry().predict_batch(
+        list(recordings.values()), window=WINDOW_SIZE, stride=inference_stride(), batch_size=INFERENCE_BATCH_SIZE
+    )
+    # Release the recordings before the LLM stage
+    predictions_by_patient = dict(zip(recordings.keys(), batch_predictions))
+    recordings.clear()
+
+    report("scoring")
+    # Every patient is scored in one vectorized call
+    patient_order = list(predictions_by_patient)
+    scores = score_conditions([predictions_by_patient[pid] for pid in patient_order]) if patient_order else []
+    summaries = {
+        patient_id: summarize_predictions(
+            predictions_by_patient[patient_id], dict(zip(CONDITIONS, (float(p) for p in row)))
+        )
+        for patient_id, row in zip(patient_order, scores)
+    }
+
+    report("llm")
+    for patient_id, (condition_probabilities, raw_data_json, percentage_data_json) in summaries.items():
+        ai_content, medication = generate_reports(predictions_by_patient[patient_id], condition_probabilities)
+        results[patient_id] = {
+            "result": {
+                "raw": raw_data_json,
+                "percentage": percentage_data_json,
+                "ai_content": ai_content,
+                "medication": medication
+            },
+            "error": None
+        }
+
+    return results
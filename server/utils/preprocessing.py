@@ -0,0 +1,302 @@
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import mne
+import numpy as np
+from scipy.signal import oaconvolve
+from utils.result_cache import cache_key
+
+logger = logging.getLogger(__name__)
+
+# Threads filtering channel groups in parallel (FFT convolution releases the GIL). One
+# pool per process is shared by all concurrent requests, so this is the process-wide cap
+PREPROCESS_N_JOBS = int(os.getenv("EEG_PREPROCESS_JOBS", str(min(os.cpu_count() or 1, 8))))
+# Recordings are read and filtered in windows of this many seconds so the working set stays bounded
+PREPROCESS_CHUNK_SECONDS = float(os.getenv("EEG_PREPROCESS_CHUNK_SECONDS", "300"))
+# Notch geometry matching mne's notch_filter defaults: width freq / 200, 1 Hz transition
+NOTCH_TRANS_BANDWIDTH = 1.0
+
+# Threads start on first use
+_filter_executor = ThreadPoolExecutor(max_workers=max(1, PREPROCESS_N_JOBS), thread_name_prefix="eeg-filter")
+
+
+@lru_cache(maxsize=16)
+def design_filter(sfreq, bandpass, notch_freqs):
+    """
+    Zero-phase FIR kernel combining the band-pass and a band-stop around each notch
+    frequency. Convolving the kernels gives one filter, so the data is filtered in a
+    single pass instead of one per stage. Arguments must be hashable (tuples).
+    """
+    l_freq, h_freq = bandpass
+    nyquist = sfreq / 2.0
+    if h_freq is not None and h_freq >= nyquist:
+        h_freq = None
+    kernel = mne.filter.create_filter(None, sfreq, l_freq, h_freq, method='fir', fir_design='firwin', verbose=False)
+
+    for freq in notch_freqs:
+        half_width = freq / 400.0 + NOTCH_TRANS_BANDWIDTH / 2
+        if freq + half_width >= nyquist:
+            logger.info(f"Skipping {freq} Hz notch: above Nyquist ({nyquist} Hz)")
+            continue
+        # l_freq > h_freq makes create_filter design a band-stop
+        notch = mne.filter.create_filter(
+            None, sfreq, freq + half_width, freq - half_width,
+            l_trans_bandwidth=NOTCH_TRANS_BANDWIDTH / 2, h_trans_bandwidth=NOTCH_TRANS_BANDWIDTH / 2,
+            method='fir', fir_design='firwin', verbose=False
+        )
+        kernel = np.convolve(kernel, notch)
+    return kernel
+
+
+def pad_edges(block, left, right):
+    """
+    Pad the ends of (channels, samples) data like mne's default 'reflect_limited': an odd
+    (point) reflection about the end sample, then zeros past one reflection. Matching it
+    keeps the recording's first and last half-kernel equal to raw.filter's output.
+    """
+    n = block.shape[1]
+    reflect_left, reflect_right = min(left, n - 1), min(right, n - 1)
+    padded = np.pad(block, ((0, 0), (reflect_left, reflect_right)), mode='reflect', reflect_type='odd')
+    if reflect_left < left or reflect_right < right:
+        padded = np.pad(padded, ((0, 0), (left - reflect_left, right - reflect_right)))
+    return padded
+
+
+def convolve_channels(block, kernel, n_jobs):
+    """'valid' convolution of each row of block with kernel, split into n_jobs channel groups on the shared filter pool."""
+    n_jobs = max(1, min(n_jobs, len(block)))
+    if n_jobs == 1:
+        return oaconvolve(block, kernel[np.newaxis, :], mode='valid', axes=1)
+    groups = np.array_split(np.arange(len(block)), n_jobs)
+    parts = _filter_executor.map(lambda idx: oaconvolve(block[idx], kernel[np.newaxis, :], mode='valid', axes=1), groups)
+    return np.concatenate(list(parts))
+
+
+def inference_spans(n_times, window, stride):
+    """
+    Sample ranges [(start, stop)] that sliding-window inference reads. Overlapping or
+    touching windows merge into one span; with stride > window only the windows are
+    kept, so concatenating the spans and stepping by window yields the same windows.
+    """
+    if n_times < window:
+        return [(0, n_times)]
+    starts = range(0, n_times - window + 1, stride)
+    if stride <= window:
+        return [(0, starts[-1] + window)]
+    return [(start, start + window) for start in starts]
+
+
+def iter_filtered(raw, bandpass, notch_freqs, spans=None, n_jobs=None, chunk_seconds=None, picks=None):
+    """
+    Band-pass and notch filter a Raw's data channels in one fused pass, yielding
+    (start, stop, data) for each requested span (the whole recording by default) in
+    order. raw does not need to be preloaded: spans are read and filtered in groups of
+    at most chunk_seconds, each extended by half the kernel length on both sides so the
+    output matches filtering the whole recording at once. Only the data channels are
+    filtered unless picks (channel indices) says otherwise; the rest (EOG, stim, ...)
+    are passed through.
+    """
+    n_jobs = PREPROCESS_N_JOBS if n_jobs is None else n_jobs
+    chunk_seconds = PREPROCESS_CHUNK_SECONDS if chunk_seconds is None else chunk_seconds
+
+    sfreq = raw.info['sfreq']
+    kernel = design_filter(sfreq, tuple(bandpass), tuple(notch_freqs))
+    half = len(kernel) // 2
+    if picks is None:
+        picks = mne.pick_types(raw.info, meg=True, eeg=True, seeg=True, ecog=True, dbs=True, exclude=[])
+    n_times = raw.n_times
+    chunk = max(int(chunk_seconds * sfreq), 1)
+
+    # Split long spans into chunks, then group neighbouring pieces into one read each
+    pieces = [
+        (start, min(start + chunk, stop))
+        for span_start, stop in (spans or [(0, n_times)])
+        for start in range(span_start, stop, chunk)
+    ]
+    groups = []
+    for piece in pieces:
+        if groups and piece[1] - groups[-1][0][0] <= chunk:
+            groups[-1].append(piece)
+        else:
+            groups.append([piece])
+
+    for group in groups:
+        start, stop = group[0][0], group[-1][1]
+        read_start, read_stop = max(0, start - half), min(n_times, stop + half)
+        block = raw.get_data(start=read_start, stop=read_stop)
+        data = block[:, start - read_start:stop - read_start].copy()
+        if len(picks):
+            # Only the recording's true ends are padded; inner chunk edges use real neighbouring samples
+            padded = pad_edges(block[picks], half - (start - read_start), half - (read_stop - stop))
+            data[picks] = convolve_channels(padded, kernel, n_jobs)
+        del block
+        for piece_start, piece_stop in group:
+            yield piece_start, piece_stop, data[:, piece_start - start:piece_stop - start]
+
+
+def filtered_info(raw, bandpass, sfreq=None):
+    """Copy of raw.info recording the applied band-pass (and a new sampling rate, if given)."""
+    info = raw.info.copy()
+    sfreq = sfreq or info['sfreq']
+    with info._unlock():
+        info['sfreq'] = sfreq
+        info['highpass'] = float(bandpass[0] or 0.0)
+        lowpass = bandpass[1] if bandpass[1] is not None else info['lowpass']
+        info['lowpass'] = float(min(lowpass, sfreq / 2.0))
+    return info
+
+
+def decimated_raw(raw, bandpass, notch_freqs, decim, extra_channels=()):
+    """
+    Filtered recording keeping every decim-th sample, small enough to fit ICA on. The
+    band-pass is the anti-alias filter, so besides the data channels it is also applied
+    to extra_channels (e.g. the EOG used to pick components); other channels are aliased.
+    """
+    picks = mne.pick_types(raw.info, meg=True, eeg=True, seeg=True, ecog=True, dbs=True, exclude=[])
+    if len(extra_channels):
+        # pick_channels with an empty list would select every channel
+        picks = np.union1d(picks, mne.pick_channels(raw.ch_names, list(extra_channels), ordered=False)).astype(int)
+    parts = []
+    for start, stop, data in iter_filtered(raw, bandpass, notch_freqs, picks=picks):
+        # Keep the global sample grid (multiples of decim) across chunk boundaries
+        parts.append(data[:, (-start) % decim::decim])
+    info = filtered_info(raw, bandpass, raw.info['sfreq'] / decim)
+    return mne.io.RawArray(np.concatenate(parts, axis=1), info, verbose=False)
+
+
+def preprocess_spans(raw, bandpass, notch_freqs, spans, ica=None, dtype=np.float32):
+    """
+    Filter (and clean with ica, if given) only the requested spans of a lazily opened
+    recording, returning them concatenated as a contiguous (channels, samples) array
+    of dtype. Peak memory is the output plus one chunk.
+    """
+    total = sum(stop - start for start, stop in spans)
+    out = np.empty((raw.info['nchan'], total), dtype=dtype)
+    info = filtered_info(raw, bandpass)
+    position = 0
+    for start, stop, data in iter_filtered(raw, bandpass, notch_freqs, spans):
+        if ica is not None:
+            # ICA is a per-sample linear map, so applying it chunk by chunk is exact
+            chunk_raw = mne.io.RawArray(data, info, verbose=False)
+            ica.apply(chunk_raw, verbose=False)
+            data = chunk_raw.get_data()
+        out[:, position:position + stop - start] = data
+        position += stop - start
+    return out
+
+
+# Fitted ICA decompositions, per patient (or "uploads") and recording hash
+ICA_CACHE_DIR = os.getenv(
+    "EEG_ICA_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "cache", "ica")
+)
+# ICA is fitted on a copy decimated towards this rate and high-passed at ICA_HIGHPASS Hz
+ICA_FIT_SFREQ = float(os.getenv("EEG_ICA_FIT_SFREQ", "100"))
+ICA_HIGHPASS = 1.0
+ICA_RANDOM_STATE = 42
+# Skip ICA when no EOG channel correlates with the EEG above this (0 disables the fast path)
+ICA_SKIP_EOG_CORR = float(os.getenv("EEG_ICA_SKIP_EOG_CORR", "0"))
+
+
+def ica_params(n_components, bandpass, notch_freqs):
+    """Everything that changes the fitted decomposition, for its cache key."""
+    return {
+        "n_components": n_components,
+        # ICA is fitted on the filtered data
+        "bandpass": list(bandpass),
+        "notch": list(notch_freqs),
+        # Decides whether ICA runs at all, so a cached decomposition only holds for the same threshold
+        "skip_eog_corr": ICA_SKIP_EOG_CORR,
+        "fit_sfreq": ICA_FIT_SFREQ,
+        "highpass": ICA_HIGHPASS,
+        "random_state": ICA_RANDOM_STATE,
+    }
+
+
+def ica_decimation(sfreq, bandpass):
+    """Decimation factor towards ICA_FIT_SFREQ that keeps the band-pass below the new Nyquist frequency."""
+    if bandpass[1] is None:
+        return 1
+    decim = max(1, int(sfreq // ICA_FIT_SFREQ))
+    return max(1, min(decim, int(sfreq // (2 * bandpass[1]))))
+
+
+def ica_cache_path(key, patient_id=None):
+    return os.path.join(ICA_CACHE_DIR, patient_id or "uploads", f"{key}-ica.fif")
+
+
+def ica_skip_path(ica_path):
+    """Marker saved next to where the decomposition would be when the EOG fast path skipped ICA."""
+    return ica_path[:-len("-ica.fif")] + "-skip"
+
+
+def eog_correlation(raw, eog_names):
+    """Largest absolute correlation between any EOG channel and any EEG channel."""
+    eeg = raw.get_data(picks="eeg")
+    eog = raw.get_data(picks=eog_names)
+    if not len(eeg) or not len(eog):
+        return 0.0
+    corr = np.corrcoef(np.vstack([eog, eeg]))[:len(eog), len(eog):]
+    return float(np.nanmax(np.abs(corr)))
+
+
+def fit_eog_ica(fit_raw, eog_names, n_components):
+    """Fit ICA on fit_raw, high-passing a copy first if needed, and mark the EOG-related components."""
+    if (fit_raw.info["highpass"] or 0) < ICA_HIGHPASS:
+        fit_raw = fit_raw.copy().filter(ICA_HIGHPASS, None, verbose=False)
+    ica = mne.preprocessing.ICA(n_components=n_components, random_state=ICA_RANDOM_STATE)
+    ica.fit(fit_raw)
+    # Find and exclude components related to eye blinks/movements
+    eog_indices, eog_scores = ica.find_bads_eog(fit_raw, ch_name=eog_names)
+    ica.exclude = eog_indices
+    return ica
+
+
+def eog_ica(raw, eog_names, n_components, bandpass, notch_freqs, recording_hash=None, patient_id=None):
+    """
+    ICA decomposition removing eye artifacts from raw, or None when there is nothing to remove.
+
+    ICA is fitted on a filtered copy of the recording decimated towards ICA_FIT_SFREQ.
+    The fitted decomposition, including its excluded components, is saved under
+    ICA_CACHE_DIR keyed on recording_hash and ica_params(), so re-analysing the same
+    recording skips both the copy and the fit. With EEG_ICA_SKIP_EOG_CORR set,
+    recordings whose EOG barely correlates with the EEG skip ICA entirely; that
+    decision is cached the same way, under the same threshold.
+    """
+    path = None
+    if recording_hash:
+        path = ica_cache_path(cache_key(recording_hash, "ica", ica_params(n_components, bandpass, notch_freqs)), patient_id)
+    if path and os.path.exists(ica_skip_path(path)):
+        logger.info(f"EOG correlation below {ICA_SKIP_EOG_CORR} (cached); skipping ICA")
+        return None
+    if path and os.path.exists(path):
+        try:
+            ica = mne.preprocessing.read_ica(path, verbose=False)
+            logger.info(f"Reusing ICA decomposition from {path}")
+            return ica if ica.exclude else None
+        except Exception as e:
+            logger.error(f"Failed to read cached ICA {path}: {e}")
+
+    fit_raw = decimated_raw(raw, bandpass, notch_freqs, ica_decimation(raw.info["sfreq"], bandpass), eog_names)
+    if ICA_SKIP_EOG_CORR > 0:
+        correlation = eog_correlation(fit_raw, eog_names)
+        if correlation < ICA_SKIP_EOG_CORR:
+            logger.info(f"EOG correlation {correlation:.3f} below {ICA_SKIP_EOG_CORR}; skipping ICA")
+            if path:
+                try:
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    with open(ica_skip_path(path), 'w') as f:
+                        f.write(f"{correlation}\n")
+                except OSError as e:
+                    logger.error(f"Failed to cache ICA skip decision at {path}: {e}")
+            return None
+
+    ica = fit_eog_ica(fit_raw, eog_names, n_components)
+    if path:
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            ica.save(path, overwrite=True, verbose=False)
+        except OSError as e:
+            logger.error(f"Failed to cache ICA decomposition at {path}: {e}")
+    return ica if ica.exclude else None
@@ -0,0 +1,42 @@
+import os
+import re
+import shutil
+import tempfile
+
+# Where each patient's most recent uploaded .fif recording is kept
+RECORDINGS_DIR = os.getenv(
+    "EEG_RECORDINGS_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "recordings")
+)
+
+_PATIENT_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]+$")
+
+
+def validate_patient_id(patient_id):
+    """Reject IDs that are unsafe to use as file names. Returns the ID unchanged."""
+    if not patient_id or not _PATIENT_ID_PATTERN.match(patient_id):
+        raise ValueError(f"Invalid patient ID: {patient_id!r}")
+    return patient_id
+
+
+def recording_path(patient_id):
+    """Path of a patient's stored recording (it may not exist yet)."""
+    validate_patient_id(patient_id)
+    # MNE expects raw FIF file names to end in raw.fif
+    return os.path.join(RECORDINGS_DIR, f"{patient_id}_raw.fif")
+
+
+def has_recording(patient_id):
+    return os.path.exists(recording_path(patient_id))
+
+
+def save_recording(patient_id, source_path):
+    """Store a copy of an uploaded recording as the patient's current recording."""
+    path = recording_path(patient_id)
+    os.makedirs(RECORDINGS_DIR, exist_ok=True)
+    # Copy then rename so readers never see a partially written file
+    fd, tmp_path = tempfile.mkstemp(dir=RECORDINGS_DIR, suffix=".tmp")
+    os.close(fd)
+    shutil.copyfile(source_path, tmp_path)
+    os.replace(tmp_path, path)
+    return path
@@ -0,0 +1,106 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from utils.files import write_json_atomic
+
+logger = logging.getLogger(__name__)
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(path):
+    """Streaming SHA-256 of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_key(file_hash, model_version, params):
+    """Key a result on the input bytes, the model that produced it and the pipeline parameters."""
+    material = json.dumps({"file": file_hash, "model": model_version, "params": params}, sort_keys=True)
+    return hashlib.sha256(material.encode()).hexdigest()
+
+
+class ResultCache:
+    """
+    Content-addressed cache of JSON-serializable analysis results.
+
+    Entries live in an in-memory LRU bounded by max_entries and, when directory
+    is set, in one JSON file per key on disk so they survive restarts and are
+    shared between processes. The disk store is bounded by max_disk_bytes,
+    evicting the least recently used files first.
+    """
+    def __init__(self, max_entries=256, directory=None, max_disk_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+        if not self.directory:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, 'r') as f:
+                value = json.load(f)
+            # Refresh the file's timestamps so disk eviction is LRU rather than FIFO
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+
+        self._remember(key, value)
+        return value
+
+    def set(self, key, value):
+        self._remember(key, value)
+        if not self.directory:
+            return
+        try:
+            write_json_atomic(self._path(key), value)
+            self._evict_disk()
+        except OSError as e:
+            logger.error(f"Failed to write result cache entry {key}: {e}")
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _evict_disk(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= size
@@ -0,0 +1,30 @@
+import json
+
+# Headers for server-sent event responses. X-Accel-Buffering stops nginx holding tokens back;
+# an explicit identity Content-Encoding makes compression middleware (e.g. starlette's
+# GZipMiddleware before 0.46, which buffers event streams) pass the stream through untouched
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "Content-Encoding": "identity"}
+SSE_DONE = "data: [DONE]\n\n"
+
+
+def sse_event(data):
+    """Format a JSON-serializable value as one server-sent event."""
+    return f"data: {json.dumps(data)}\n\n"
+
+
+def parse_stream_line(line):
+    """
+    Parse one line of an OpenAI-compatible streaming completion. Returns the token text
+    ("" for blank lines, comments and chunks without content) or None once the stream is done.
+    """
+    if isinstance(line, bytes):
+        line = line.decode("utf-8")
+    line = line.strip()
+    if not line.startswith("data:"):
+        return ""
+    payload = line[len("data:"):].strip()
+    if payload == "[DONE]":
+        return None
+    chunk = json.loads(payload)
+    choices = chunk.get("choices") or [{}]
+    return choices[0].get("delta", {}).get("content") or ""